@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""
+A long-lived server holding the parsed structure of a tree in memory, so questions about it are answered
+without parsing anything.
+
+The tree is parsed once (or loaded from an incremental.py snapshot), then kept warm along with the inherits_from
+hierarchy, an in-memory call_index and a static import resolver.  "refresh" re-parses only the files that
+changed since, and patches all three.
+
+Requests and responses are single lines of JSON over a Unix socket:
+
+    { "query" : "inheritsFrom", "args" : { "names" : [ "model_base.BASEV2" ] } }
+    { "query" : "calls", "args" : { "pattern" : "db.api.*", "exact" : false } }
+    { "query" : "resolve", "args" : { "target" : "nova.db.api" } }   (a module path, or a file of the tree)
+    { "query" : "refresh", "args" : { "files" : [ ... ] } }          (no files: compare mtimes)
+
+Examples:
+
+./analysis_daemon.py serve /tmp/nova.sock /opt/stack/nova/nova --snapshot /tmp/nova.snapshot &
+./analysis_daemon.py query /tmp/nova.sock inheritsFrom model_base.BASEV2
+./analysis_daemon.py query /tmp/nova.sock calls 'db.api.*'
+./analysis_daemon.py query /tmp/nova.sock resolve nova.db.api
+./analysis_daemon.py query /tmp/nova.sock refresh
+./analysis_daemon.py query /tmp/nova.sock shutdown
+"""
+
+import json
+import os
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+import time
+
+import ast_parser
+import call_index
+import import_resolver
+import incremental
+import inherits_from
+import parse_cache
+
+class AnalysisState(object):
+    """
+        Everything the daemon answers from: a snapshot (see incremental.py) and what is derived from it.
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> open(os.path.join(targetDir, "a.py"), "w").write("import os\\nclass Foo(Base):\\n    def f(self):\\n        os.path.join('a')\\n")
+        >>> state = AnalysisState(incremental.buildSnapshot(targetDir))
+        >>> state.inheritsFrom([ "Base" ]).keys()
+        ['Foo']
+        >>> [ ( site["function"], site["lineno"] ) for site in state.calls("os.path.*") ]
+        [('f', 4)]
+        >>> state.resolve("os")["filepath"] == os.__file__.replace(".pyc", ".py")
+        True
+        >>> open(os.path.join(targetDir, "b.py"), "w").write("class Bar(Foo):\\n    pass\\n")
+        >>> [ os.path.basename(filename) for filename in state.refresh()["updated"] ]
+        ['b.py']
+        >>> sorted(state.inheritsFrom([ "Base" ]).keys())
+        ['Bar', 'Foo']
+        >>> open(os.path.join(targetDir, "b.py"), "w").write("class Bar(Foo:\\n")
+        >>> summary = state.refresh()
+        >>> summary["updated"], [ os.path.basename(filename) for filename in summary["failed"] ], state.refresh()["failed"]
+        ([], ['b.py'], {})
+        >>> open(os.path.join(targetDir, "b.py"), "w").write("class Baz(Foo):\\n    pass\\n")
+        >>> summary = state.refresh([ os.path.join(targetDir, "b.py") ])
+        >>> sorted(state.inheritsFrom([ "Base" ]).keys()), summary["failed"]
+        (['Baz', 'Foo'], {})
+        >>> shutil.rmtree(targetDir)
+    """
+    def __init__(self, snapshot, extraRoots=None):
+        self.snapshot = snapshot
+        self.extraRoots = list(extraRoots or []) + [ snapshot["targetDir"] ]
+        self.index = call_index.CallIndex(":memory:")
+        for filename, outbound in snapshot["files"].iteritems():
+            self.index.addFile(filename, outbound, replace=False)
+        self.index.commit()
+        self.rebuild()
+
+    def rebuild(self):
+        """ Pick up what changed in the snapshot: its hierarchy is patched by incremental.applyChanges, the
+            resolver is recomputed as a whole
+        """
+        self.graph = self.snapshot["hierarchy"]
+        # The module trie lists each directory once, start over so new and deleted modules are seen
+        self.resolver = import_resolver.StaticResolver(self.extraRoots)
+
+    def inheritsFrom(self, names):
+        return inherits_from.findSubclasses(self.graph, names)
+
+    def calls(self, pattern, exact=False):
+        return self.index.query(pattern, exact)
+
+    def resolve(self, target):
+        """ What target (a module path) resolves to, or for a file of the tree, what each of its imports does """
+        filename = os.path.abspath(target)
+        if filename not in self.snapshot["files"]:
+            return self.resolver.resolve(target)
+
+        resolved = {}
+        for imports in self.snapshot["files"][filename]["imports"].values():
+            for modulePath in imports.values():
+                resolved[modulePath] = self.resolver.resolve(modulePath, filename)
+        return resolved
+
+    def refresh(self, files=None):
+        """ Re-parse the given (or the polled) changed files, and patch everything derived from them.  Files that
+            don't parse keep their previous structure, and come back under "failed" with their error.
+        """
+        if not files:
+            files = incremental.polledChangedFiles(self.snapshot)
+        summary = incremental.applyChanges(self.snapshot, files)
+        for filename in summary["deleted"]:
+            self.index.removeFile(filename)
+        for filename in summary["updated"]:
+            self.index.addFile(filename, self.snapshot["files"][filename])
+        self.index.commit()
+        if len(summary["updated"]) > 0 or len(summary["deleted"]) > 0:
+            self.rebuild()
+        return { "updated" : summary["updated"], "deleted" : summary["deleted"], "failed" : summary["failed"] }
+
+class AnalysisHandler(SocketServer.StreamRequestHandler):
+    """ One JSON request per line, one JSON response per line, for as long as the client keeps the connection """
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            start = time.time()
+            try:
+                request = json.loads(line)
+                result = self.server.answer(request["query"], request.get("args") or {})
+                response = { "result" : result }
+            except Exception as ex:
+                response = { "error" : "%s: %s" % ( type(ex).__name__, ex ) }
+            response["seconds"] = round(time.time() - start, 6)
+            self.wfile.write(json.dumps(response, default=repr) + "\n")
+            self.wfile.flush()
+
+class AnalysisServer(SocketServer.UnixStreamServer):
+    """
+        Answers queries about state.  Requests are handled one at a time, so a refresh never overlaps a query.
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> open(os.path.join(targetDir, "a.py"), "w").write("class Foo(Base):\\n    pass\\n")
+        >>> socketPath = os.path.join(targetDir, "daemon.sock")
+        >>> server = AnalysisServer(socketPath, AnalysisState(incremental.buildSnapshot(targetDir)))
+        >>> thread = threading.Thread(target=server.serve_forever)
+        >>> thread.start()
+        >>> query(socketPath, "inheritsFrom", names=[ "Base" ]).keys()
+        [u'Foo']
+        >>> query(socketPath, "nothing")
+        Traceback (most recent call last):
+        ...
+        Exception: ValueError: unknown query nothing
+        >>> query(socketPath, "shutdown")
+        >>> thread.join()
+        >>> shutil.rmtree(targetDir)
+    """
+    def __init__(self, socketPath, state, snapshotPath=None):
+        removeStaleSocket(socketPath)
+        SocketServer.UnixStreamServer.__init__(self, socketPath, AnalysisHandler)
+        self.socketPath = socketPath
+        self.state = state
+        self.snapshotPath = snapshotPath
+        self.queries = {
+            "inheritsFrom" : lambda names: state.inheritsFrom(names),
+            "calls" : lambda pattern, exact=False: state.calls(pattern, exact),
+            "resolve" : lambda target: state.resolve(target),
+            "refresh" : self.refresh,
+            "shutdown" : self.stop,
+        }
+
+    def answer(self, name, args):
+        if name not in self.queries:
+            raise ValueError("unknown query %s" % name)
+        return self.queries[name](**dict([ ( str(key), value ) for key, value in args.iteritems() ]))
+
+    def refresh(self, files=None):
+        summary = self.state.refresh(files)
+        if self.snapshotPath is not None and ( len(summary["updated"]) > 0 or len(summary["deleted"]) > 0 or len(summary["failed"]) > 0 ):
+            incremental.saveSnapshot(self.snapshotPath, self.state.snapshot)
+        return summary
+
+    def stop(self):
+        # shutdown() waits for serve_forever to return, which can't happen while this request is being handled
+        threading.Thread(target=self.shutdown).start()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+def removeStaleSocket(socketPath):
+    """ Remove the socket a daemon that is gone left behind at socketPath.  Anything else there is left alone: a
+        file that isn't a socket, or a socket some daemon still answers on, is an error.
+
+        >>> import tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> socketPath = os.path.join(directory, "daemon.sock")
+        >>> removeStaleSocket(socketPath)
+        >>> open(socketPath, "w").write("not a socket")
+        >>> removeStaleSocket(socketPath) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        Exception: ... exists and is not a socket, refusing to remove it
+        >>> os.remove(socketPath)
+        >>> listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        >>> listener.bind(socketPath)
+        >>> listener.listen(1)
+        >>> removeStaleSocket(socketPath) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        Exception: something is already listening on ..., refusing to remove it
+        >>> listener.close()
+        >>> removeStaleSocket(socketPath)
+        >>> os.path.exists(socketPath), os.rmdir(directory)
+        (False, None)
+    """
+    try:
+        mode = os.lstat(socketPath).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception("%s exists and is not a socket, refusing to remove it" % socketPath)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+    except socket.error:
+        os.remove(socketPath)
+        return
+    finally:
+        client.close()
+    raise Exception("something is already listening on %s, refusing to remove it" % socketPath)
+
+def query(socketPath, name, **args):
+    """ Ask the daemon listening on socketPath, returning the result or raising its error """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+        client.sendall(json.dumps({ "query" : name, "args" : args }) + "\n")
+        response = json.loads(client.makefile().readline())
+    finally:
+        client.close()
+    if "error" in response:
+        raise Exception(response["error"])
+    return response["result"]
+
+def loadState(targetDir, snapshotPath=None, extraRoots=None, cache=None, workers=1):
+    """ The state for targetDir, from snapshotPath (brought up to date) when it has one, parsed from scratch otherwise.
+        A snapshot of another tree is never replaced by this one.
+
+        >>> import shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> snapshotPath = os.path.join(directory, "snapshot")
+        >>> for name in ( "one", "two" ):
+        ...     os.mkdir(os.path.join(directory, name))
+        ...     open(os.path.join(directory, name, "a.py"), "w").write("class Foo(Base):\\n    pass\\n")
+        >>> loadState(os.path.join(directory, "one"), snapshotPath).inheritsFrom([ "Base" ]).keys()
+        ['Foo']
+        >>> loadState(os.path.join(directory, "two"), snapshotPath) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        Exception: snapshot ... is of .../one, not of .../two
+        >>> incremental.loadSnapshot(snapshotPath)["targetDir"] == os.path.join(directory, "one")
+        True
+        >>> shutil.rmtree(directory)
+    """
+    snapshot = None
+    if snapshotPath is not None and os.path.exists(snapshotPath):
+        try:
+            snapshot = incremental.loadSnapshot(snapshotPath)
+        except Exception as ex:
+            sys.stderr.write("%s, parsing from scratch\n" % ex)
+        if snapshot is not None and snapshot["targetDir"] != os.path.abspath(targetDir):
+            raise Exception("snapshot %s is of %s, not of %s" % ( snapshotPath, snapshot["targetDir"], os.path.abspath(targetDir) ))
+
+    if snapshot is None:
+        snapshot = incremental.buildSnapshot(targetDir, cache=cache, workers=workers)
+        if snapshotPath is not None:
+            incremental.saveSnapshot(snapshotPath, snapshot)
+        return AnalysisState(snapshot, extraRoots)
+
+    state = AnalysisState(snapshot, extraRoots)
+    state.refresh()
+    return state
+
+def usage():
+    print "usage: analysis_daemon.py serve SOCKET DIR [--snapshot PATH] [--root DIR]... [--jobs N] [--cache DIR]"
+    print "       analysis_daemon.py query SOCKET inheritsFrom CLASS..."
+    print "       analysis_daemon.py query SOCKET calls [--exact] PATTERN"
+    print "       analysis_daemon.py query SOCKET resolve MODULE|FILE"
+    print "       analysis_daemon.py query SOCKET refresh [FILE...]"
+    print "       analysis_daemon.py query SOCKET shutdown"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    if len(sys.argv) < 4:
+        usage()
+
+    command = sys.argv[1]
+    socketPath = sys.argv[2]
+
+    if command == "serve":
+        jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+        snapshotPath = ast_parser.popArgument(sys.argv, "--snapshot")
+        extraRoots = ast_parser.popArguments(sys.argv, "--root")
+        cache = None
+        cacheDir = ast_parser.popArgument(sys.argv, "--cache")
+        if cacheDir is not None:
+            cache = parse_cache.ParseCache(cacheDir)
+        if len(sys.argv) != 4:
+            usage()
+
+        state = loadState(sys.argv[3], snapshotPath, extraRoots, cache, jobs)
+        server = AnalysisServer(socketPath, state, snapshotPath)
+        sys.stderr.write("%d files loaded, listening on %s\n" % ( len(state.snapshot["files"]), socketPath ))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    elif command == "query":
+        name = sys.argv[3]
+        if name == "inheritsFrom":
+            result = query(socketPath, name, names=sys.argv[4:])
+        elif name == "calls":
+            exact = "--exact" in sys.argv
+            args = [ arg for arg in sys.argv if arg != "--exact" ]
+            if len(args) != 5:
+                usage()
+            result = query(socketPath, name, pattern=args[4], exact=exact)
+        elif name == "resolve" and len(sys.argv) == 5:
+            target = sys.argv[4]
+            if os.path.exists(target):
+                target = os.path.abspath(target)
+            result = query(socketPath, name, target=target)
+        elif name == "refresh":
+            result = query(socketPath, name, files=[ os.path.abspath(filename) for filename in sys.argv[4:] ])
+        elif name == "shutdown":
+            result = query(socketPath, name)
+        else:
+            usage()
+        if result is not None:
+            print json.dumps(result, indent=4, sort_keys=True)
+
+    else:
+        usage()
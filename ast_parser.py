@@ -8,38 +8,75 @@ A traditional "dump" from ast directly does not clearly depict the hierarchy of
 This program has it's own problems, as it doesn't handle all of the possibilities that a programmer can do.
 I wrote this to target parsing OpenStack to determine where database calls were made for every API call of every service (seriously).
 
-usage: ./ast_parser [filename]
+usage: ./ast_parser [--jobs N | --prefetch N] [--profile NAME] [--dedup] [--cache DIR] [--compact] [--stats] [--spill DIR [--memory-budget MB]] [--jsonl | --jsonl-calls | --binary FILE]
+       [--include PATTERN]... [--exclude PATTERN]... [filename or directory...]
+
+--jsonl writes one JSON record per file as soon as it is parsed, --jsonl-calls one per call/assignment site.
+--binary streams the results into a compact binary file FILE, readable a file or class at a time (see binary_result).
+--stats reports the time spent per phase and the slowest files on stderr.
+--spill keeps memory bounded by writing each file's result to shard files in DIR as soon as it is parsed.
+--profile imports|classes|full only extracts the imports, or the classes and imports, or everything (the default).
+--dedup parses files with identical content once, re-labelling the result for the copies.
+--prefetch N reads up to N files ahead, on reader threads, while parsing (single process only).
+--include / --exclude are gitignore style patterns picking the files of directories (see file_walker), *.py by default.
 
 r.dietrich
 8 November 2018
 """
 
 import ast
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import pickle
+import Queue
 import sys
-from pprint import pprint
+import threading
+import time
+from pprint import pprint, saferepr
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s : %(message)s" )
+# Bump this whenever the structure produced by handleFile changes, it invalidates persisted parse caches
+PARSER_VERSION = "2"
 
-class Current(object):
-    outbound = { "classes" : {}, "imports" : {} }
-    currentFilename = ""
-    currentFullPath = ""
+# Files per pool task when the number of files isn't known up front
+STREAM_CHUNKSIZE = 16
 
-    @staticmethod
-    def reset():
-        Current.outbound = { "classes" : {}, "imports" : {} }
-        Current.currentFilename = ""
+# Reader threads of the prefetching (pipelined) mode, and how many files they may read ahead by default
+READER_THREADS = 4
+DEFAULT_PREFETCH = 64
 
-    @staticmethod
-    def buildCurrent(name, inheritsFrom):
-        Current.outbound["classes"][name] = {
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s : %(message)s" )
+
+class ParseContext(object):
+    """
+        The state of a single parse: the outbound structure being built, and the file it belongs to.
+
+        A fresh context is handed to FuncLister for every file, so several files can be parsed at once
+        (threads, an embedding service, ...) without sharing anything.
+
+        >>> context = ParseContext("/abc/moocow.py")
+        >>> context.currentFilename
+        'moocow'
+        >>> context.buildCurrent("moocow", [])
+        >>> FuncLister(context).visit(ast.parse("abc = 'def'"))
+        >>> context.outbound['classes']['moocow']['assignments'][0]['value']
+        'def'
+    """
+    def __init__(self, filename=""):
+        self.outbound = { "classes" : {}, "imports" : {} }
+        self.currentFilename = getBasenameFromFilename(filename)
+        self.currentFullPath = filename
+
+    def buildCurrent(self, name, inheritsFrom):
+        self.outbound["classes"][name] = {
             "functions" : {},
             "assignments" : [],
             "inheritsFrom" : inheritsFrom
         }
-        Current.outbound["imports"][name] = {}
+        self.outbound["imports"][name] = {}
 
     @staticmethod
     def add(
@@ -59,228 +96,436 @@ class Current(object):
             "value" : value
         })
 
-class ChildOfAttributeLister(ast.NodeVisitor):
-    def visit_Attribute(self, node):
-        logging.debug("(%d) Child of attribute!" % node.lineno)
-
-        myAttr = None
-        if hasattr(node, "attr"):
-            logging.debug("    (%d) %s (ATTR)" % ( node.lineno, node.attr ))
-            myAttr = node.attr
-        elif hasattr(node, "id"):
-            logging.debug("    (%d) %s (ID)" % ( node.lineno, node.id ))
-            self.objectPath.append(node.id)
-
-        self.generic_visit(node)
-
-        if myAttr is not None:
-            logging.debug("    %s - %d (ATTR)" % ( myAttr, node.lineno ))
-            self.objectPath.append(node.attr)
-
-    def visit_Call(self, node):
-        #print dir(node)
-        #print dir(node.func)
-        #print dir(node.func.value)
-        #print dir(node.func.value.value)
-        #print node.func.value.value.id
-        #print node.lineno
-        #print node.col_offset
-        #print "\n\n"
-
-        if hasattr(node.func, "id"):
-            method = node.func.id
-        else:
-            method = None # FIXME
+class Current(object):
+    """
+        The process wide parse context used by a FuncLister created without one.  Kept for callers that
+        drive FuncLister by hand; handleFile uses a ParseContext per file instead.
+    """
+    outbound = { "classes" : {}, "imports" : {} }
+    currentFilename = ""
+    currentFullPath = ""
 
-        outbound = {
-            "currentClass" : self.currentClass,
-            "currentFunction" : self.currentFunction,
-            "method" : method,
-            "args" : [],
-            "lineno" : node.lineno,
-            "col_offset" : node.col_offset
+    @staticmethod
+    def reset():
+        Current.outbound = { "classes" : {}, "imports" : {} }
+        Current.currentFilename = ""
+
+    @staticmethod
+    def buildCurrent(name, inheritsFrom):
+        Current.outbound["classes"][name] = {
+            "functions" : {},
+            "assignments" : [],
+            "inheritsFrom" : inheritsFrom
         }
-        for arg in node.args:
-            cal = ChildOfAttributeLister()
-            cal.objectPath = []
-            cal.currentClass = self.currentClass
-            cal.currentFunction = self.currentFunction
-            cal.visit(arg)
-            outbound["args"].append(cal.objectPath)
-
-        self.objectPath.append(outbound)
-
-    def visit_Name(self, node):
-        logging.debug("(%d) Name of Child attribute: %s, class=%s, function=%s" % ( node.lineno, node.id, self.currentClass, self.currentFunction ))
-        self.objectPath.append(node.id)
-
-    def visit_Str(self, node):
-        self.objectPath.append(node.s)
-        logging.debug("(%d) Str of Child attribute: %s, class=%s, function=%s" % ( node.lineno, node.s, self.currentClass, self.currentFunction ))
-
-class ChildOfCallLister(ast.NodeVisitor):
-    def visit_Attribute(self, node):
-        logging.debug("(%d) Child of call: type=%s" % ( node.lineno, type(node) ))
-
-        ca = ChildOfAttributeLister()
-        ca.currentClass = self.currentClass
-        ca.currentFunction = self.currentFunction
-        ca.objectPath = self.objectPath
-        ca.visit(node)
-
-class ChildOfFunctionLister(ast.NodeVisitor):
-    # Arguments to current function we are parsing
-    def visit_arguments(self, node):
-        logging.debug("Child of function: type=%s" % ( type(node) ))
-        for arg in node.args:
-            self.myParams.append(arg.id)
+        Current.outbound["imports"][name] = {}
 
-    def visit_ImportFrom(self, node):
-        for nm in node.names:
-            if nm.asname is not None:
-                Current.outbound["imports"][Current.currentFilename][nm.asname] = "%s.%s" % ( node.module, nm.name )
-            else:
-                Current.outbound["imports"][Current.currentFilename][nm.name] = "%s.%s" % ( node.module, nm.name )
+    add = staticmethod(ParseContext.add)
 
-    def visit_Import(self, node):
-        for nm in node.names:
-            #print "Import: %s as %s" % ( nm.name, nm.asname )
-            if nm.asname is not None:
-                Current.outbound["imports"][Current.currentFilename][nm.asname] = nm.name
-            else:
-                Current.outbound["imports"][Current.currentFilename][nm.name] = nm.name
+SITE_FIELDS = (
+    "currentFunction", "currentClass", "currentFilename", "method", "args",
+    "lineno", "col_offset", "target", "value"
+)
 
-    def visit_Call(self, node):
-        argsToCall = []
-        for arg in node.args:
-            if isinstance(arg, ast.Call):
-                if hasattr(arg, "func") and hasattr(arg.func, "attr"):
-                    # If the function takes functions as arguments, then we gotta go handle that as well :(
-                    # XXX refactor to re-use existing functions at some point :/
-                    childOfCall = ChildOfCallLister()
-                    childOfCall.objectPath = []
-                    childOfCall.currentClass = self.currentClass
-                    childOfCall.currentFunction = self.currentFunction
-                    childOfCall.visit(arg.func)
-                    #childOfCall.objectPath.reverse()
-
-                    Current.add(
-                        Current.outbound["classes"][self.currentClass]["functions"][self.currentFunction]["calls"],
-                        self.currentClass, self.currentFunction, Current.currentFullPath,
-                        childOfCall.objectPath, argsToCall, arg.func.lineno, arg.func.col_offset
-                    )
-            else:
-                cal = ChildOfAttributeLister()
-                cal.objectPath = []
-                cal.currentClass = self.currentClass
-                cal.currentFunction = self.currentFunction
-                cal.visit(arg)
-                #print cal.objectPath
-                argsToCall.append(cal.objectPath)
-
-        childOfCall = ChildOfCallLister()
-        childOfCall.objectPath = []
-
-        if hasattr(node, "func") and hasattr(node.func, "id"):
-            childOfCall.objectPath.append(node.func.id)
-            logging.debug("(%d) Function list func: %s" % ( node.lineno, node.func.id ))
-
-        childOfCall.currentClass = self.currentClass
-        childOfCall.currentFunction = self.currentFunction
-        childOfCall.visit(node.func)
-
-        #childOfCall.objectPath.reverse()
-
-        Current.outbound["classes"][self.currentClass]["functions"][self.currentFunction]["arguments"] = self.myParams
-        #seeIfMethodCallsSubordinateObjectNotImported(childOfCall.objectPath, Current.outbound["imports"][Current.currentFilename])
-
-        Current.add(
-            Current.outbound["classes"][self.currentClass]["functions"][self.currentFunction]["calls"],
-            self.currentClass, self.currentFunction, Current.currentFullPath, childOfCall.objectPath,
-            argsToCall, node.lineno, node.col_offset
-        )
+FUNCTION_FIELDS = ( "calls", "assignments", "lineno", "currentClass", "currentFilename", "arguments" )
 
-class CallForAssignLister(ast.NodeVisitor):
-    def visit_Call(self, node):
-        for arg in node.args:
-            cal = ChildOfAttributeLister()
-            cal.objectPath = []
-            cal.currentClass = self.currentClass
-            cal.currentFunction = self.currentFunction
-            # XXX TODO REMOVE FOO
-            #print arg
-            #print dir(arg)
-            #print arg.func.id
-            #print dir(cal)
-            cal.visit(arg)
-            # elements in the argpath separated by dots are backwards (ie: compute_api.self vs. self.compute_api)
-            #cal.objectPath.reverse()
-            #print "helloooooo"
-            #print cal.objectPath
-            #self.argPath.append(".".join(cal.objectPath))
-            self.argPath.append(cal.objectPath)
-
-        childOfCall = ChildOfCallLister()
-        childOfCall.objectPath = []
-
-        if hasattr(node, "func") and hasattr(node.func, "id"):
-            childOfCall.objectPath.append(node.func.id)
-
-        childOfCall.currentClass = self.currentClass
-        childOfCall.currentFunction = self.currentFunction
-        childOfCall.visit(node.func)
-        self.objectPath = childOfCall.objectPath
-
-class AssignsForFunctionLister(ast.NodeVisitor):
-    def visit_Assign(self, node):
-        cal2 = ChildOfAttributeLister()
-        cal2.currentClass = self.currentClass
-        cal2.currentFunction = self.currentFunction
-        cal2.objectPath = []
-        cal2.visit(node.targets[0])
+def compactValue(value, seen):
+    """ Lists become tuples and strings get interned, so identical paths and names are shared between
+        records.  seen maps id() of already converted lists, keeping lists that were shared, shared, and each
+        converted path (a tuple of names) to the first equal one, so equal paths are only held once per file.
 
-        if isinstance(node.value, ast.Call):
-            # example foo = Thing.otherFunction()
-            cal = CallForAssignLister()
-            cal.currentClass = self.currentClass
-            cal.currentFunction = self.currentFunction
-            cal.argPath = []
-            cal.objectPath = []
-            cal.visit(node.value)
-
-            Current.add(
-                Current.outbound["classes"][self.currentClass]["functions"][self.currentFunction]["assignments"],
-                self.currentClass, self.currentFunction, Current.currentFullPath,
-                cal.objectPath, cal.argPath, node.lineno, node.col_offset, cal2.objectPath
-            )
+        >>> seen = {}
+        >>> compactValue([ "self", [ "db", "api" ] ], seen)
+        ('self', ('db', 'api'))
+        >>> compactValue([ "db", "api" ], seen) is compactValue([ "db", "api" ], seen)
+        True
+    """
+    if value.__class__ is str:
+        return intern(value)
+    elif value.__class__ is list:
+        converted = seen.get(id(value))
+        if converted is None:
+            converted = tuple([ compactValue(item, seen) for item in value ])
+            # Only tuples of names and of such tuples, which compare and hash cheaply (and unlike str and unicode,
+            # can't be equal while being different): the ids of those shared so far are marked True in seen
+            if all([ item.__class__ is str or ( item.__class__ is tuple and seen.get(id(item)) is True ) for item in converted ]):
+                converted = seen.setdefault(converted, converted)
+                seen[id(converted)] = True
+            seen[id(value)] = converted
+        return converted
+    elif value.__class__ is dict:
+        if len(value) == len(SITE_FIELDS) and "col_offset" in value:
+            # A call passed as an argument
+            return SiteRecord.fromDict(value, seen)
+        return dict([ ( key, compactValue(item, seen) ) for key, item in value.iteritems() ])
+    return value
+
+def expandValue(value):
+    """ The reverse of compactValue.
+
+        >>> expandValue(('self', ('db', 'api')))
+        ['self', ['db', 'api']]
+    """
+    if value.__class__ is tuple:
+        return [ expandValue(item) for item in value ]
+    elif value.__class__ is SiteRecord:
+        return value.asDict()
+    elif value.__class__ is dict:
+        return dict([ ( key, expandValue(item) ) for key, item in value.iteritems() ])
+    return value
+
+class SiteRecord(object):
+    """
+        A slotted call/assignment record, the compact alternative to the dicts built by ParseContext.add.
+        Paths are tuples of interned strings (value is left alone).  Records can still be read like the
+        dicts they replace.
+
+        >>> record = SiteRecord("foo", "Bar", "/abc/bar.py", ("self", "db", "get"), (), 4, 8)
+        >>> record["method"]
+        ('self', 'db', 'get')
+        >>> record.asDict()["method"]
+        ['self', 'db', 'get']
+        >>> pickle.loads(pickle.dumps(record)) == record
+        True
+    """
+    __slots__ = SITE_FIELDS
 
-        elif isinstance(node.value, ast.Attribute):
-            # example: foo = Thing.otherThing
+    def __init__(
+        self, currentFunction, currentClass, currentFilename,
+        method, args, lineno, col_offset,
+        target=None, value=None
+    ):
+        self.currentFunction = currentFunction
+        self.currentClass = currentClass
+        self.currentFilename = currentFilename
+        self.method = method
+        self.args = args
+        self.lineno = lineno
+        self.col_offset = col_offset
+        self.target = target
+        self.value = value
 
-            cal = ChildOfAttributeLister() # Get the right hand side
-            cal.currentClass = self.currentClass
-            cal.currentFunction = self.currentFunction
-            cal.objectPath = []
-            cal.visit(node.value)
+    @staticmethod
+    def fromDict(record, seen):
+        # Evaluated literal values are kept as they are, they may hold genuine tuples.  A lazy one is evaluated
+        # now though: its value is a fraction of the size of the syntax tree it holds on to until then.
+        values = [ compactValue(record[field], seen) for field in SITE_FIELDS[:-1] ]
+        if isinstance(record["value"], LazyLiteral):
+            record["value"].value
+        return SiteRecord(*values, value=record["value"])
+
+    def asDict(self):
+        record = dict([ ( field, expandValue(getattr(self, field)) ) for field in SITE_FIELDS[:-1] ])
+        record["value"] = self.value
+        return record
+
+    def __getitem__(self, key):
+        if key not in SITE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in SITE_FIELDS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(SITE_FIELDS)
+
+    def __getstate__(self):
+        return tuple([ getattr(self, field) for field in SITE_FIELDS ])
+
+    def __setstate__(self, state):
+        for field, value in zip(SITE_FIELDS, state):
+            setattr(self, field, value)
+
+    def __eq__(self, other):
+        if isinstance(other, SiteRecord):
+            return self.__getstate__() == other.__getstate__()
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, SiteRecord):
+            return self.__getstate__() != other.__getstate__()
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "SiteRecord(%s)" % ", ".join([ "%s=%r" % ( field, getattr(self, field) ) for field in SITE_FIELDS ])
+
+class FunctionRecord(object):
+    """
+        A slotted function entry, the compact alternative to the dict visit_FunctionDef builds (a six key dict
+        is a 1KB table, this is a tenth of that).  It reads (and can be updated) like the dict it replaces, a
+        key the dict didn't have is an unset slot.
+
+        >>> function = FunctionRecord.fromDict({ "calls" : [], "assignments" : [], "lineno" : 3, "currentClass" : "Foo", "currentFilename" : "/abc/foo.py" }, {})
+        >>> function["lineno"], "arguments" in function, sorted(dict(function).keys())
+        (3, False, ['assignments', 'calls', 'currentClass', 'currentFilename', 'lineno'])
+        >>> pickle.loads(pickle.dumps(function, pickle.HIGHEST_PROTOCOL)) == function
+        True
+    """
+    __slots__ = FUNCTION_FIELDS
 
-            Current.add(
-                Current.outbound["classes"][self.currentClass]["functions"][self.currentFunction]["assignments"],
-                self.currentClass, self.currentFunction, Current.currentFullPath,
-                cal.objectPath, node.lineno, node.col_offset, cal2.objectPath
-            )
+    @staticmethod
+    def fromDict(function, seen):
+        record = FunctionRecord()
+        record.calls = [ toSiteRecord(site, seen) for site in function["calls"] ]
+        record.assignments = [ toSiteRecord(site, seen) for site in function["assignments"] ]
+        for key in ( "lineno", "currentClass", "currentFilename", "arguments" ):
+            if key in function:
+                setattr(record, key, compactValue(function[key], seen))
+        return record
+
+    def __getitem__(self, key):
+        if key not in FUNCTION_FIELDS or not hasattr(self, key):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in FUNCTION_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in FUNCTION_FIELDS and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in FUNCTION_FIELDS else default
+
+    def keys(self):
+        return [ field for field in FUNCTION_FIELDS if hasattr(self, field) ]
+
+    def copy(self):
+        record = FunctionRecord()
+        record.__setstate__(self.__getstate__())
+        return record
+
+    def __getstate__(self):
+        return dict([ ( field, getattr(self, field) ) for field in self.keys() ])
+
+    def __setstate__(self, state):
+        for field, value in state.iteritems():
+            setattr(self, field, value)
+
+    def __eq__(self, other):
+        if isinstance(other, FunctionRecord):
+            return self.__getstate__() == other.__getstate__()
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, FunctionRecord):
+            return self.__getstate__() != other.__getstate__()
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "FunctionRecord(%s)" % ", ".join([ "%s=%r" % ( field, getattr(self, field) ) for field in self.keys() ])
+
+def compactOutbound(outbound):
+    """ Convert the outbound structure of one file, in place, to Function/SiteRecords and interned, shared tuple
+        paths.
+
+        >>> outbound = compactOutbound(handleFile("abc", "def foo(a):\\n    a.b(1)\\n", {})["abc"])
+        >>> outbound["classes"]["abc"]["functions"]["foo"]["calls"][0].method
+        ('a', 'b')
+        >>> expandOutbound(outbound) == handleFile("abc", "def foo(a):\\n    a.b(1)\\n", {})["abc"]
+        True
+    """
+    seen = {}
+    for clz, classInfo in outbound["classes"].iteritems():
+        classInfo["inheritsFrom"] = compactValue(classInfo["inheritsFrom"], seen)
+        classInfo["assignments"] = [ toSiteRecord(record, seen) for record in classInfo["assignments"] ]
+        for name, function in classInfo["functions"].items():
+            if not isinstance(function, FunctionRecord):
+                classInfo["functions"][name] = FunctionRecord.fromDict(function, seen)
+    return outbound
+
+def toSiteRecord(record, seen):
+    if isinstance(record, SiteRecord):
+        return record
+    return SiteRecord.fromDict(record, seen)
+
+def expandOutbound(outbound):
+    """ The dict producing adapter: a copy of a compacted outbound structure, in the original dict/list form. """
+    expanded = { "classes" : {}, "imports" : dict([ ( clz, dict(imports) ) for clz, imports in outbound["imports"].iteritems() ]) }
+    for clz, classInfo in outbound["classes"].iteritems():
+        functions = {}
+        for name, function in classInfo["functions"].iteritems():
+            functions[name] = dict(function)
+            for key in ( "calls", "assignments" ):
+                functions[name][key] = [ expandRecord(record) for record in function[key] ]
+            for key in ( "currentClass", "currentFilename", "arguments" ):
+                if key in function:
+                    functions[name][key] = expandValue(function[key])
+        expanded["classes"][clz] = {
+            "functions" : functions,
+            "assignments" : [ expandRecord(record) for record in classInfo["assignments"] ],
+            "inheritsFrom" : expandValue(classInfo["inheritsFrom"])
+        }
+    return expanded
 
-        elif isinstance(node.value, ast.Str):
+def expandRecord(record):
+    if isinstance(record, SiteRecord):
+        return record.asDict()
+    return record
 
-            Current.add(
-                Current.outbound["classes"][self.currentClass]["functions"][self.currentFunction]["assignments"],
-                self.currentClass, self.currentFunction, Current.currentFullPath,
-                node.value.s, node.lineno, node.col_offset, cal2.objectPath
-            )
+class LazyLiteral(object):
+    """
+        The value of a module or class level Dict/List assignment.  Only the expression's subtree is kept, it is
+        evaluated with ast.literal_eval (literals only, nothing gets executed) the first time the value is asked
+        for, and the result is cached.  Anything that isn't a plain literal evaluates to None, as a whole: a list
+        with a single name or call in it is None, not a list with a hole.
+
+        It reprs like pprint prints the value (dict keys sorted), so printed results don't depend on dict order.
+
+        Pickling (the parse cache, pool workers, spill stores) stores the evaluated value, not the subtree.
+
+        >>> literal = LazyLiteral(ast.parse("{ 'a' : [ 1, 2 ] }").body[0].value)
+        >>> literal.value
+        {'a': [1, 2]}
+        >>> literal == { 'a' : [ 1, 2 ] }
+        True
+        >>> LazyLiteral(ast.parse("[ 1, os.system('true') ]").body[0].value).value is None
+        True
+        >>> LazyLiteral(ast.parse("{ 'b' : 1, 'a' : { 'd' : 2, 'c' : 3 } }").body[0].value)
+        {'a': {'c': 3, 'd': 2}, 'b': 1}
+        >>> pickle.loads(pickle.dumps(literal)) == literal
+        True
+    """
+    __slots__ = ( "node", "lineno", "col_offset", "evaluated" )
+
+    def __init__(self, node):
+        self.node = node
+        self.lineno = node.lineno
+        self.col_offset = node.col_offset
+        self.evaluated = None
+
+    @property
+    def value(self):
+        if self.node is not None:
+            try:
+                self.evaluated = ast.literal_eval(self.node)
+            except Exception:
+                logging.debug("(%d) Error evaluating expression!", self.lineno)
+                self.evaluated = None
+            self.node = None
+        return self.evaluated
+
+    def __getstate__(self):
+        return ( self.lineno, self.col_offset, self.value )
+
+    def __setstate__(self, state):
+        self.lineno, self.col_offset, self.evaluated = state
+        self.node = None
+
+    def __eq__(self, other):
+        if isinstance(other, LazyLiteral):
+            return self.value == other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return saferepr(self.value)
+
+def objectPath(node, currentClass, currentFunction, path=None):
+    """ Flatten the names, attributes, strings and calls found under node into a list, in source order.
+
+        >>> objectPath(ast.parse("self.compute_api.get").body[0].value, "moocow", "")
+        ['self', 'compute_api', 'get']
+        >>> objectPath(ast.parse("foo(a.b)").body[0].value, "moocow", "bar")[0]['args']
+        [['a', 'b']]
+    """
+    if path is None:
+        path = []
+
+    cls = node.__class__
+    if cls is ast.Name:
+        path.append(node.id)
+    elif cls is ast.Attribute:
+        objectPath(node.value, currentClass, currentFunction, path)
+        path.append(node.attr)
+    elif cls is ast.Str:
+        path.append(node.s)
+    elif cls is ast.Call:
+        path.append({
+            "currentClass" : currentClass,
+            "currentFunction" : currentFunction,
+            "method" : node.func.id if hasattr(node.func, "id") else None, # FIXME
+            "args" : [ objectPath(arg, currentClass, currentFunction) for arg in node.args ],
+            "lineno" : node.lineno,
+            "col_offset" : node.col_offset
+        })
+    else:
+        for field in node._fields:
+            child = getattr(node, field, None)
+            if isinstance(child, ast.AST):
+                objectPath(child, currentClass, currentFunction, path)
+            elif isinstance(child, list):
+                for item in child:
+                    if isinstance(item, ast.AST):
+                        objectPath(item, currentClass, currentFunction, path)
+    return path
+
+def callPath(node, currentClass, currentFunction, path):
+    """ Append the dotted path of the attributes found under a called expression (node.func) to path.
+        Bare names are left to the caller, which adds func.id itself.
+    """
+    if node.__class__ is ast.Attribute:
+        objectPath(node, currentClass, currentFunction, path)
+        return path
+
+    for field in node._fields:
+        child = getattr(node, field, None)
+        if isinstance(child, ast.AST):
+            callPath(child, currentClass, currentFunction, path)
+        elif isinstance(child, list):
+            for item in child:
+                if isinstance(item, ast.AST):
+                    callPath(item, currentClass, currentFunction, path)
+    return path
+
+def methodPath(node, currentClass, currentFunction):
+    """ The method path of a call, ie: self.db.instance_get(...) -> [ 'self', 'db', 'instance_get' ]
+
+        >>> methodPath(ast.parse("self.db.instance_get(ctx)").body[0].value, "moocow", "")
+        ['self', 'db', 'instance_get']
+        >>> methodPath(ast.parse("foo()").body[0].value, "moocow", "")
+        ['foo']
+    """
+    path = []
+    if hasattr(node.func, "id"):
+        path.append(node.func.id)
+    return callPath(node.func, currentClass, currentFunction, path)
+
+def addImports(node, imports):
+    if node.__class__ is ast.ImportFrom:
+        for nm in node.names:
+            if nm.asname is not None:
+                imports[nm.asname] = "%s.%s" % ( node.module, nm.name )
+            else:
+                imports[nm.name] = "%s.%s" % ( node.module, nm.name )
+    else:
+        for nm in node.names:
+            if nm.asname is not None:
+                imports[nm.asname] = nm.name
+            else:
+                imports[nm.name] = nm.name
 
 class FuncLister(ast.NodeVisitor):
     """
         This class extends NodeVisitor and handles imports, class definitions and functions.
 
+        Module and class level statements are visited here; each function body is then walked exactly once
+        by walkFunction, which collects the calls, arguments, imports and assignments of the function together.
+
+        Everything is written into the given ParseContext (the global Current one when none is given).
+
         >>> Current.reset()
         >>> Current.currentFilename = "moocow"
         >>> Current.buildCurrent("moocow", [])
@@ -301,132 +546,174 @@ class FuncLister(ast.NodeVisitor):
         >>> len(Current.outbound['classes']['moocow']['functions'].keys())
         0
     """
+    def __init__(self, context=Current):
+        self.context = context
+
+    def generic_visit(self, node):
+        # Statements (the only thing handled at this level) never live inside expressions, so only the
+        # statement lists (body, orelse, handlers, finalbody) need to be followed.
+        for field in node._fields:
+            child = getattr(node, field, None)
+            if isinstance(child, list):
+                for item in child:
+                    if isinstance(item, ast.stmt) or isinstance(item, ast.excepthandler):
+                        self.visit(item)
+
     def visit_Import(self, node):
-        #print "IMPORT !!!! %s - %s" % ( node.names[0].name, node.names[0].asname )
-        for nm in node.names:
-            #print "Import: %s as %s" % ( nm.name, nm.asname )
-            if nm.asname is not None:
-                Current.outbound["imports"][Current.currentFilename][nm.asname] = nm.name
-            else:
-                Current.outbound["imports"][Current.currentFilename][nm.name] = nm.name
+        addImports(node, self.context.outbound["imports"][self.context.currentFilename])
 
     def visit_ImportFrom(self, node):
-        #print "    from import - module %s - %s" % ( node.module, str(node.names) )
-        for nm in node.names:
-            if nm.asname is not None:
-                Current.outbound["imports"][Current.currentFilename][nm.asname] = "%s.%s" % ( node.module, nm.name )
-            else:
-                Current.outbound["imports"][Current.currentFilename][nm.name] = "%s.%s" % ( node.module, nm.name )
-
-            #print "From import: %s, %s as %s" % ( node.module, nm.name, nm.asname )
+        addImports(node, self.context.outbound["imports"][self.context.currentFilename])
 
     def visit_ClassDef(self, node):
         self.currentClass = node.name
 
         inheritsFrom = []
         for base in node.bases:
-            cal2 = ChildOfAttributeLister()
-            cal2.currentClass = self.currentClass
-            cal2.currentFunction = ""
-            cal2.objectPath = []
-            cal2.visit(base)
-            #cal2.objectPath.reverse()
-            inheritsFrom.append(cal2.objectPath)
-
-        Current.buildCurrent(self.currentClass, inheritsFrom)
-        #self.generic_visit(node)
+            inheritsFrom.append(objectPath(base, self.currentClass, ""))
+
+        self.context.buildCurrent(self.currentClass, inheritsFrom)
         for item in node.body:
             self.visit(item)
-        self.currentClass = Current.currentFilename
+        self.currentClass = self.context.currentFilename
 
     def visit_FunctionDef(self, node):
-        myCurrentClass = Current.currentFilename
+        myCurrentClass = self.context.currentFilename
         if hasattr(self, "currentClass"):
             myCurrentClass = self.currentClass
 
-        Current.outbound["classes"][myCurrentClass]["functions"][node.name] = {
+        function = {
             "calls" : [],
             "lineno" : node.lineno,
             "assignments" : [],
             "currentClass" : myCurrentClass,
-            "currentFilename" : Current.currentFullPath,
+            "currentFilename" : self.context.currentFullPath,
         }
+        self.context.outbound["classes"][myCurrentClass]["functions"][node.name] = function
+
+        self.functionClass = myCurrentClass
+        self.functionName = node.name
+        self.function = function
+        self.functionParams = []
+        self.functionImports = self.context.outbound["imports"][self.context.currentFilename]
+        self.walkFunction(node)
+
+    def walkFunction(self, node):
+        """ Single pass over everything below a function definition (nested definitions included) """
+        cls = node.__class__
+        if cls is ast.Call:
+            self.functionCall(node)
+            return
+        elif cls is ast.arguments:
+            for arg in node.args:
+                self.functionParams.append(arg.id)
+            return
+        elif cls is ast.Import or cls is ast.ImportFrom:
+            addImports(node, self.functionImports)
+            return
+        elif cls is ast.Assign:
+            self.functionAssign(node)
+
+        for field in node._fields:
+            child = getattr(node, field, None)
+            if isinstance(child, ast.AST):
+                self.walkFunction(child)
+            elif isinstance(child, list):
+                for item in child:
+                    if isinstance(item, ast.AST):
+                        self.walkFunction(item)
+
+    def functionCall(self, node):
+        currentClass = self.functionClass
+        currentFunction = self.functionName
+        calls = self.function["calls"]
+
+        argsToCall = []
+        for arg in node.args:
+            if isinstance(arg, ast.Call):
+                if hasattr(arg, "func") and hasattr(arg.func, "attr"):
+                    # If the function takes functions as arguments, then we gotta go handle that as well :(
+                    self.context.add(
+                        calls, currentClass, currentFunction, self.context.currentFullPath,
+                        callPath(arg.func, currentClass, currentFunction, []), argsToCall,
+                        arg.func.lineno, arg.func.col_offset
+                    )
+            else:
+                argsToCall.append(objectPath(arg, currentClass, currentFunction))
 
-        il = ChildOfFunctionLister()
-        il.currentFunction = node.name
-        il.currentClass    = myCurrentClass
-        il.myParams        = []
-        il.visit(node)
+        self.function["arguments"] = self.functionParams
+
+        self.context.add(
+            calls, currentClass, currentFunction, self.context.currentFullPath,
+            methodPath(node, currentClass, currentFunction), argsToCall, node.lineno, node.col_offset
+        )
 
-        al = AssignsForFunctionLister()
-        al.currentFunction = node.name
-        al.currentClass = myCurrentClass
-        al.visit(node)
+    def functionAssign(self, node):
+        currentClass = self.functionClass
+        currentFunction = self.functionName
+        assignments = self.function["assignments"]
+
+        target = objectPath(node.targets[0], currentClass, currentFunction)
+
+        if isinstance(node.value, ast.Call):
+            # example foo = Thing.otherFunction()
+            argPath = [ objectPath(arg, currentClass, currentFunction) for arg in node.value.args ]
+            self.context.add(
+                assignments, currentClass, currentFunction, self.context.currentFullPath,
+                methodPath(node.value, currentClass, currentFunction), argPath,
+                node.lineno, node.col_offset, target
+            )
+
+        elif isinstance(node.value, ast.Attribute):
+            # example: foo = Thing.otherThing
+            self.context.add(
+                assignments, currentClass, currentFunction, self.context.currentFullPath,
+                objectPath(node.value, currentClass, currentFunction), node.lineno, node.col_offset, target
+            )
+
+        elif isinstance(node.value, ast.Str):
+            self.context.add(
+                assignments, currentClass, currentFunction, self.context.currentFullPath,
+                node.value.s, node.lineno, node.col_offset, target
+            )
 
     def visit_Assign(self, node):
-        myCurrentClass = Current.currentFilename
+        myCurrentClass = self.context.currentFilename
         if hasattr(self, "currentClass"):
             myCurrentClass = self.currentClass
 
         # Get the full name of the "left hand side" name
-        cal2 = ChildOfAttributeLister()
-        cal2.currentClass = myCurrentClass
-        cal2.currentFunction = ""
-        cal2.objectPath = []
-        cal2.visit(node.targets[0])
-        # XXX not sure about this commented out line
-        #cal2.objectPath.reverse()
+        target = objectPath(node.targets[0], myCurrentClass, "")
 
         if isinstance(node.value, ast.Call):
             # example foo = Thing.otherFunction()
-
-            cal = CallForAssignLister()
-            cal.currentClass = myCurrentClass
-            cal.currentFunction = ""
-            cal.argPath = []
-            cal.objectPath = []
-            cal.visit(node.value)
-
-            Current.add(
-                Current.outbound["classes"][myCurrentClass]["assignments"],
-                myCurrentClass, None, Current.currentFullPath, cal.objectPath,
-                cal.argPath, node.lineno, node.col_offset, cal2.objectPath
+            argPath = [ objectPath(arg, myCurrentClass, "") for arg in node.value.args ]
+            self.context.add(
+                self.context.outbound["classes"][myCurrentClass]["assignments"],
+                myCurrentClass, None, self.context.currentFullPath, methodPath(node.value, myCurrentClass, ""),
+                argPath, node.lineno, node.col_offset, target
             )
 
         elif isinstance(node.value, ast.Attribute):
             # example: foo = Thing.otherThing
-
-            # Get the right hand side
-            cal = ChildOfAttributeLister()
-            cal.currentClass = myCurrentClass
-            cal.currentFunction = ""
-            cal.objectPath = []
-            cal.visit(node.value)
-
-            #print "  assign? : objectPath=%s" % ( cal.objectPath )
-            Current.add(
-                Current.outbound["classes"][myCurrentClass]["assignments"],
-                myCurrentClass, None, Current.currentFullPath, cal.objectPath,
-                node.lineno, node.col_offset, cal2.objectPath
+            self.context.add(
+                self.context.outbound["classes"][myCurrentClass]["assignments"],
+                myCurrentClass, None, self.context.currentFullPath, objectPath(node.value, myCurrentClass, ""),
+                node.lineno, node.col_offset, target
             )
 
         elif isinstance(node.value, ast.Str):
-            Current.add(
-                Current.outbound["classes"][myCurrentClass]["assignments"],
-                myCurrentClass, None, Current.currentFullPath, None, None,
-                node.lineno, node.col_offset, cal2.objectPath, node.value.s
+            self.context.add(
+                self.context.outbound["classes"][myCurrentClass]["assignments"],
+                myCurrentClass, None, self.context.currentFullPath, None, None,
+                node.lineno, node.col_offset, target, node.value.s
             )
         elif isinstance(node.value, ast.Dict) or isinstance(node.value, ast.List):
-            try:
-                value = eval(compile(ast.Expression(node.value), "<ast expression>", "eval"))
-            except Exception as ex:
-                logging.debug("(%d) Error evaluating expression!" % node.lineno)
-                value = None
-
-            Current.add(
-                Current.outbound["classes"][myCurrentClass]["assignments"],
-                myCurrentClass, None, Current.currentFullPath, None, None,
-                node.lineno, node.col_offset, cal2.objectPath, value
+            # Only evaluated (safely) if somebody looks at it
+            self.context.add(
+                self.context.outbound["classes"][myCurrentClass]["assignments"],
+                myCurrentClass, None, self.context.currentFullPath, None, None,
+                node.lineno, node.col_offset, target, LazyLiteral(node.value)
             )
 
 #def seeIfMethodCallsSubordinateObjectNotImported(methodPath, imports):
@@ -450,6 +737,146 @@ class FuncLister(ast.NodeVisitor):
 #                imports[unresolved] = computed
 #        pos = pos + 1
 
+class ClassLister(FuncLister):
+    """
+        The "classes" profile: classes, what they inherit from, and the module level imports.  Function bodies
+        and assignments are skipped.
+
+        >>> context = ParseContext("abc.py")
+        >>> context.buildCurrent(context.currentFilename, [])
+        >>> ClassLister(context).visit(ast.parse("import os\\nclass Foo(Base):\\n    x = 1\\n    def f(self):\\n        os.getcwd()\\n"))
+        >>> context.outbound["classes"]["Foo"]["inheritsFrom"], context.outbound["classes"]["Foo"]["functions"]
+        ([['Base']], {})
+    """
+    def visit_FunctionDef(self, node):
+        pass
+
+    def visit_Assign(self, node):
+        pass
+
+class ImportLister(FuncLister):
+    """
+        The "imports" profile: every import of the file, wherever it is (functions included).  Only the statements
+        of function bodies are looked at, nothing is recorded for functions or assignments.
+
+        >>> context = ParseContext("abc.py")
+        >>> context.buildCurrent(context.currentFilename, [])
+        >>> ImportLister(context).visit(ast.parse("import os\\nclass Foo(Base):\\n    def f(self):\\n        from a import b\\n"))
+        >>> sorted(context.outbound["imports"]["abc"].items()), sorted(context.outbound["classes"].keys())
+        ([('b', 'a.b'), ('os', 'os')], ['Foo', 'abc'])
+    """
+    def visit_FunctionDef(self, node):
+        self.walkImports(node)
+
+    def walkImports(self, node):
+        """ The imports of a function, imports are statements so expressions are never looked into """
+        for field in node._fields:
+            child = getattr(node, field, None)
+            if isinstance(child, list):
+                for item in child:
+                    if item.__class__ is ast.Import or item.__class__ is ast.ImportFrom:
+                        addImports(item, self.context.outbound["imports"][self.context.currentFilename])
+                    elif isinstance(item, ast.stmt) or isinstance(item, ast.excepthandler):
+                        self.walkImports(item)
+
+    def visit_Assign(self, node):
+        pass
+
+# What each extraction profile visits the tree with, lighter profiles leave the rest of the structure empty
+PROFILES = {
+    "full" : FuncLister,
+    "classes" : ClassLister,
+    "imports" : ImportLister,
+}
+
+def renameModule(value, basename, newBasename):
+    """ value, with the currentClass of the calls within it that were made at the module level of basename
+        moved to newBasename.  Whatever has none is returned as it is, shared, not copied.
+    """
+    cls = value.__class__
+    if basename == newBasename:
+        return value
+    elif cls is list or cls is tuple:
+        items = [ renameModule(item, basename, newBasename) for item in value ]
+        for pos in range(len(items)):
+            if items[pos] is not value[pos]:
+                return items if cls is list else tuple(items)
+        return value
+    elif cls is dict or cls is SiteRecord:
+        renamed = relabelRecord(value, None, basename, newBasename)
+        for key in SITE_FIELDS:
+            if renamed.get(key) is not value.get(key):
+                return renamed
+        return value
+    return value
+
+def relabelRecord(record, fullPath, basename, newBasename):
+    """ A copy of a call or assignment record (or a call within its paths, which has no fullPath) for the copy
+        of its file at fullPath, whose module is newBasename.
+    """
+    if isinstance(record, SiteRecord):
+        record = dict(zip(SITE_FIELDS, record.__getstate__()))
+        return SiteRecord(**relabelRecord(record, fullPath, basename, newBasename))
+
+    record = dict(record)
+    if fullPath is not None:
+        record["currentFilename"] = fullPath
+    if basename != newBasename:
+        for key, item in record.items():
+            if key == "currentClass":
+                if item == basename:
+                    record[key] = newBasename
+            elif key != "value" and key != "currentFilename": # value is a literal, not something the parser built
+                record[key] = renameModule(item, basename, newBasename)
+    return record
+
+def canRelabel(outbound, original, fullPath):
+    """ Whether relabelOutbound can turn the structure of original into that of fullPath: not when the module
+        of fullPath would take the name of one of the classes.
+    """
+    newBasename = getBasenameFromFilename(fullPath)
+    return newBasename == getBasenameFromFilename(original) or newBasename not in outbound["classes"]
+
+def relabelOutbound(outbound, original, fullPath):
+    """ The outbound structure of fullPath, a file identical to original, which outbound was parsed from (see
+        canRelabel).  The records and whatever else names the file or its module are copied, the paths and
+        values that don't (most of them) are shared with outbound.
+
+        >>> outbound = handleFile("/a/foo.py", "import os\\ndef f():\\n    g(x)\\n", {})["/a/foo.py"]
+        >>> copy = relabelOutbound(outbound, "/a/foo.py", "/b/bar.py")
+        >>> sorted(copy["classes"].keys()), sorted(copy["imports"].keys())
+        (['bar'], ['bar'])
+        >>> call = copy["classes"]["bar"]["functions"]["f"]["calls"][0]
+        >>> call["currentFilename"], call["currentClass"]
+        ('/b/bar.py', 'bar')
+        >>> call["args"] is outbound["classes"]["foo"]["functions"]["f"]["calls"][0]["args"]
+        True
+        >>> copy["imports"]["bar"] is outbound["imports"]["foo"]
+        False
+        >>> expandOutbound(relabelOutbound(compactOutbound(outbound), "/a/foo.py", "/b/bar.py")) == handleFile("/b/bar.py", "import os\\ndef f():\\n    g(x)\\n", {})["/b/bar.py"]
+        True
+    """
+    basename = getBasenameFromFilename(original)
+    newBasename = getBasenameFromFilename(fullPath)
+    classes = {}
+    for clz, classInfo in outbound["classes"].iteritems():
+        functions = {}
+        for name, function in classInfo["functions"].iteritems():
+            function = function.copy()
+            function["currentFilename"] = fullPath
+            if function.get("currentClass") == basename:
+                function["currentClass"] = newBasename
+            for key in ( "calls", "assignments" ):
+                function[key] = [ relabelRecord(record, fullPath, basename, newBasename) for record in function[key] ]
+            functions[name] = function
+        classes[newBasename if clz == basename else clz] = {
+            "functions" : functions,
+            "assignments" : [ relabelRecord(record, fullPath, basename, newBasename) for record in classInfo["assignments"] ],
+            "inheritsFrom" : renameModule(classInfo["inheritsFrom"], basename, newBasename)
+        }
+    imports = dict([ ( newBasename if clz == basename else clz, dict(names) ) for clz, names in outbound["imports"].iteritems() ])
+    return { "classes" : classes, "imports" : imports }
+
 def getBasenameFromFilename(filename):
     """ A simple function for getting the filename from a path.
 
@@ -458,9 +885,78 @@ def getBasenameFromFilename(filename):
     """
     return os.path.basename(filename).split(".")[0]
 
-def handleFile(filename, fileContent, toReturn):
+class ParseStats(object):
+    """
+        Optional instrumentation of a parse: wall time per phase, and per file the time, AST node count and
+        number of records emitted.  Nothing is measured (or counted) unless a ParseStats is passed in.
+
+        >>> stats = ParseStats()
+        >>> res = parseFiles([ sys.argv[0] ], stats=stats)
+        >>> report = stats.report(topN=1)
+        >>> report["files"] == 1 and report["nodes"] > 0 and report["records"] > 0
+        True
+        >>> "parse" in report["phases"] and "visit" in report["phases"]
+        True
+        >>> [ slowest["filename"] for slowest in report["slowest"] ] == [ sys.argv[0] ]
+        True
+    """
+    def __init__(self):
+        self.phases = {}
+        self.fileStats = []
+        self.cacheHits = 0
+        self.duplicates = 0
+
+    def addPhase(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def addFile(self, filename, seconds, nodes, records):
+        self.fileStats.append(( seconds, filename, nodes, records ))
+
+    def merge(self, other):
+        for phase, seconds in other.phases.iteritems():
+            self.addPhase(phase, seconds)
+        self.fileStats.extend(other.fileStats)
+        self.cacheHits += other.cacheHits
+        self.duplicates += other.duplicates
+
+    def report(self, topN=10):
+        slowest = sorted(self.fileStats, reverse=True)[:topN]
+        return {
+            "files" : len(self.fileStats),
+            "cacheHits" : self.cacheHits,
+            "duplicates" : self.duplicates,
+            "nodes" : sum([ nodes for seconds, filename, nodes, records in self.fileStats ]),
+            "records" : sum([ records for seconds, filename, nodes, records in self.fileStats ]),
+            "phases" : dict([ ( phase, round(seconds, 6) ) for phase, seconds in self.phases.iteritems() ]),
+            "slowest" : [
+                { "filename" : filename, "seconds" : round(seconds, 6), "nodes" : nodes, "records" : records }
+                for seconds, filename, nodes, records in slowest
+            ]
+        }
+
+    def formatReport(self, topN=10):
+        report = self.report(topN)
+        lines = [ "files=%d cacheHits=%d duplicates=%d nodes=%d records=%d" % (
+            report["files"], report["cacheHits"], report["duplicates"], report["nodes"], report["records"]
+        ) ]
+        for phase in sorted(report["phases"].keys()):
+            lines.append("    %-14s %10.3fs" % ( phase, report["phases"][phase] ))
+        lines.append("slowest files:")
+        for slowest in report["slowest"]:
+            lines.append("    %10.3fs %8d nodes %6d records  %s" % ( slowest["seconds"], slowest["nodes"], slowest["records"], slowest["filename"] ))
+        return "\n".join(lines)
+
+def countRecords(outbound):
+    records = 0
+    for classInfo in outbound["classes"].itervalues():
+        records += len(classInfo["assignments"])
+        for function in classInfo["functions"].itervalues():
+            records += len(function["calls"]) + len(function["assignments"])
+    return records
+
+def handleFile(filename, fileContent, toReturn, stats=None, profile="full"):
     """ Given a file, it's content, and a return structure to modify in place,
-        parse the AST of the content.
+        parse the AST of the content.  profile is one of PROFILES, to only extract part of the structure.
 
         >>> res = handleFile("abc", "a = 'abc'", {})
         >>> "abc" in res
@@ -469,37 +965,478 @@ def handleFile(filename, fileContent, toReturn):
         True
         >>> len(res['abc']['classes']['abc']['assignments']) == 1
         True
+        >>> len(handleFile("abc", "a = 'abc'", {}, profile="imports")['abc']['classes']['abc']['assignments'])
+        0
     """
 
-    Current.reset()
-    cf = getBasenameFromFilename(filename)
-    Current.currentFilename = cf
-    Current.currentFullPath = filename
-    Current.buildCurrent(cf, [])
+    lister = PROFILES[profile]
+    context = ParseContext(filename)
+    context.buildCurrent(context.currentFilename, [])
+    if stats is None:
+        tree = ast.parse(fileContent)
+        #print ast.dump(tree, False)
+        lister(context).visit(tree)
+        toReturn[filename] = context.outbound
+        return toReturn
+
+    start = time.time()
     tree = ast.parse(fileContent)
-    #print ast.dump(tree, False)
-    FuncLister().visit(tree)
-    toReturn[filename] = Current.outbound
+    parsed = time.time()
+    lister(context).visit(tree)
+    visited = time.time()
+    stats.addPhase("parse", parsed - start)
+    stats.addPhase("visit", visited - parsed)
+    stats.addFile(filename, visited - start, sum(1 for node in ast.walk(tree)), countRecords(context.outbound))
+    toReturn[filename] = context.outbound
     return toReturn
 
-def parseFiles(files):
+def parseOne(filename, cache=None, compact=False, stats=None, profile="full"):
+    """ Parse a single file (possibly in a worker process), returning ( filename, outbound ).
+        When a parse_cache.ParseCache is given, the file is only parsed if it changed since it was cached.
+        When compact is set, the records are SiteRecords (see compactOutbound).  stats is a ParseStats.
+        profile is one of PROFILES.
+
+        >>> filename, outbound = parseOne(sys.argv[0])
+        >>> filename == sys.argv[0] and "classes" in outbound
+        True
+    """
+    outbound = None
+    if cache is not None:
+        start = time.time()
+        outbound = cache.get(filename, profile)
+        if stats is not None:
+            stats.addPhase("cache", time.time() - start)
+            stats.cacheHits += outbound is not None
+
+    fileContent = None
+    st = None
+    if outbound is None:
+        start = time.time()
+        st, fileContent = readStamped(filename, cache)
+        if stats is not None:
+            stats.addPhase("read", time.time() - start)
+    return parseRead(filename, outbound, fileContent, cache, compact, stats, profile, st)
+
+def readStamped(filename, cache=None):
+    """ ( os.stat, content ) of filename, the stat taken first (only needed for the cache, None without one) """
+    st = os.stat(filename) if cache is not None else None
+    return st, open(filename).read()
+
+def parseRead(filename, outbound, fileContent, cache=None, compact=False, stats=None, profile="full", st=None):
+    """ The CPU half of parseOne, once the I/O is done: outbound came from the cache, or fileContent was read
+        (after st was taken)
+    """
+    if outbound is None:
+        outbound = handleFile(filename, fileContent, {}, stats, profile)[filename]
+        if cache is not None:
+            cache.put(filename, fileContent, outbound, profile, st)
+
+    if compact:
+        compactOutbound(outbound)
+    return filename, outbound
+
+def prefetchFiles(files, prefetch=DEFAULT_PREFETCH, cache=None, readers=READER_THREADS, profile="full"):
+    """ Read files ahead of whoever consumes them, from a pool of reader threads, yielding
+        ( filename, outbound, fileContent, st ) in completion order: outbound when the cache has the file,
+        otherwise the file's content and (with a cache) its os.stat from before it was read.
+
+        At most prefetch files are held waiting to be consumed, the readers block until there is room, so
+        memory stays bounded however far ahead the readers could get.  A file that can't be read raises its
+        error when its turn comes, like reading it in place would.
+
+        >>> [ ( filename, len(fileContent) > 0 ) for filename, outbound, fileContent, st in prefetchFiles([ sys.argv[0] ]) ] == [ ( sys.argv[0], True ) ]
+        True
+    """
+    files = iter(files)
+    filesLock = threading.Lock()
+    ready = Queue.Queue(max(1, prefetch))
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        # Check for an abandoned consumer now and then, instead of blocking on a full queue forever
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def reader():
+        while not stopped.is_set():
+            with filesLock:
+                filename = next(files, done)
+            if filename is done:
+                break
+            try:
+                outbound = None
+                if cache is not None:
+                    outbound = cache.get(filename, profile)
+                st, fileContent = readStamped(filename, cache) if outbound is None else ( None, None )
+                put(( filename, outbound, fileContent, st, None ))
+            except Exception:
+                put(( filename, None, None, None, sys.exc_info() ))
+        put(done)
+
+    threads = []
+    for pos in range(max(1, readers)):
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        running = len(threads)
+        while running > 0:
+            item = ready.get()
+            if item is done:
+                running -= 1
+                continue
+            filename, outbound, fileContent, st, error = item
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield filename, outbound, fileContent, st
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+def readFiles(files, cache=None, profile="full"):
+    """ prefetchFiles without the readers: each file is looked up in the cache, or read, when its turn comes """
+    for filename in files:
+        outbound = cache.get(filename, profile) if cache is not None else None
+        st, fileContent = readStamped(filename, cache) if outbound is None else ( None, None )
+        yield filename, outbound, fileContent, st
+
+def parseOneWithStats(filename, cache=None, compact=False, profile="full"):
+    """ parseOne for pool workers, handing back the worker's ParseStats with the result """
+    stats = ParseStats()
+    filename, outbound = parseOne(filename, cache, compact, stats, profile)
+    return filename, outbound, stats
+
+def iterParseFiles(files, workers=1, cache=None, compact=False, stats=None, prefetch=0, profile="full"):
+    """ Parse the files passed in as arguments, yielding ( filename, outbound ) one file at a time as soon as
+        each one is done, so callers can stream results without holding the whole run in memory.
+
+        When workers is greater than one, the files are handed out in chunks to a pool of worker processes
+        and yielded in completion order.  files can be any iterable, a generator is consumed as the pool goes.
+
+        cache is an optional parse_cache.ParseCache, shared by all workers (its size is checked once they are done).  compact produces SiteRecords
+        instead of dicts for every call and assignment.  stats is an optional ParseStats to fill in.
+
+        With prefetch (and a single worker), files are read (and looked up in the cache) by prefetchFiles'
+        reader threads while earlier ones are being parsed, up to prefetch files ahead.
+
+        profile is one of PROFILES: "imports" and "classes" skip everything but the imports, or the classes
+        (what they inherit from) and module level imports.
+
+        >>> [ filename for filename, outbound in iterParseFiles([ sys.argv[0] ]) ] == [ sys.argv[0] ]
+        True
+        >>> [ filename for filename, outbound in iterParseFiles([ sys.argv[0] ], prefetch=4) ] == [ sys.argv[0] ]
+        True
+    """
+    if workers <= 1 and prefetch > 0:
+        prefetched = prefetchFiles(files, prefetch, cache, profile=profile)
+        while True:
+            # Time spent waiting on the readers is I/O the parsing didn't hide
+            start = time.time()
+            item = next(prefetched, None)
+            if stats is not None:
+                stats.addPhase("read", time.time() - start)
+            if item is None:
+                return
+            filename, outbound, fileContent, st = item
+            if stats is not None and cache is not None:
+                stats.cacheHits += outbound is not None
+            yield parseRead(filename, outbound, fileContent, cache, compact, stats, profile, st)
+
+    if workers <= 1:
+        for filename in files:
+            yield parseOne(filename, cache, compact, stats, profile)
+        return
+
+    if hasattr(files, "__len__"):
+        if len(files) == 0:
+            return
+        # Several chunks per worker keeps the pool busy when file sizes vary wildly
+        chunksize = max(1, len(files) / (workers * 4))
+    else:
+        # A stream of paths (file_walker.walkFiles), parsing starts while it is still being produced
+        chunksize = STREAM_CHUNKSIZE
+    pool = multiprocessing.Pool(workers)
+    try:
+        if stats is None:
+            for item in pool.imap_unordered(functools.partial(parseOne, cache=cache, compact=compact, profile=profile), files, chunksize):
+                yield item
+        else:
+            parse = functools.partial(parseOneWithStats, cache=cache, compact=compact, profile=profile)
+            for filename, outbound, workerStats in pool.imap_unordered(parse, files, chunksize):
+                stats.merge(workerStats)
+                yield filename, outbound
+    finally:
+        pool.close()
+        pool.join()
+        if cache is not None:
+            # The workers' copies of the cache don't keep it within its size
+            cache.checkSize()
+
+def parseReadWithStats(key, filename, fileContent, st=None, cache=None, compact=False, profile="full"):
+    """ parseRead for pool workers, on content the parent read: ( key, filename, outbound, ParseStats, error ) """
+    stats = ParseStats()
+    try:
+        filename, outbound = parseRead(filename, None, fileContent, cache, compact, stats, profile, st)
+    except Exception as ex:
+        return key, filename, None, stats, ex
+    return key, filename, outbound, stats, None
+
+def iterDeduplicated(files, workers=1, cache=None, compact=False, stats=None, prefetch=0, profile="full"):
+    """ iterParseFiles, parsing each distinct content only once.  A file with the same content as one already
+        parsed gets a relabelled copy of its result (see relabelOutbound).
+
+        Files are read once (by prefetchFiles' readers, with prefetch), hashed as they arrive and parsed from
+        what was read, so results stream like iterParseFiles'.  With workers, a copy of a file still being
+        parsed is yielded as soon as that is done.  The result of every distinct content is kept for the copies
+        still to come: memory grows with the distinct files, not with the copies.
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> paths = [ os.path.join(targetDir, name) for name in ( "a/api.py", "b/api.py", "c/other.py" ) ]
+        >>> for path in paths:
+        ...     os.makedirs(os.path.dirname(path))
+        ...     open(path, "w").write("def f():\\n    g(x)\\n")
+        >>> stats = ParseStats()
+        >>> dict(iterDeduplicated(paths, stats=stats)) == parseFiles(paths)
+        True
+        >>> stats.report()["files"], stats.duplicates
+        (1, 2)
+        >>> dict(iterDeduplicated(paths, workers=2)) == parseFiles(paths)
+        True
+        >>> shutil.rmtree(targetDir)
+    """
+    parsed = {}    # sha1 of a content -> ( filename, outbound ) of the first file with it
+    pending = {}   # sha1 of a content a worker is parsing -> [ files with the same content, read meanwhile ]
+
+    def contentKey(fileContent):
+        start = time.time()
+        key = hashlib.sha1(fileContent).hexdigest()
+        if stats is not None:
+            stats.addPhase("hash", time.time() - start)
+        return key
+
+    def copyOf(key, filename):
+        original, outbound = parsed[key]
+        if not canRelabel(outbound, original, filename):
+            return None
+        if stats is not None:
+            stats.duplicates += 1
+        return filename, relabelOutbound(outbound, original, filename)
+
+    prefetched = prefetchFiles(files, prefetch, cache, profile=profile) if prefetch > 0 else readFiles(files, cache, profile)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    finished = Queue.Queue()
+    exhausted = False
+    try:
+        while not exhausted or len(pending) > 0:
+            # Several files per worker keeps the pool busy when file sizes vary wildly
+            while not exhausted and ( pool is None or len(pending) < workers * 4 ):
+                start = time.time()
+                item = next(prefetched, None)
+                if stats is not None:
+                    stats.addPhase("read", time.time() - start)
+                if item is None:
+                    exhausted = True
+                    break
+                filename, outbound, fileContent, st = item
+                if outbound is not None:
+                    if stats is not None:
+                        stats.cacheHits += 1
+                    yield parseRead(filename, outbound, None, cache, compact, stats, profile)
+                    continue
+
+                key = contentKey(fileContent)
+                if key in pending:
+                    pending[key].append(filename)
+                    continue
+                copy = copyOf(key, filename) if key in parsed else None
+                if copy is not None:
+                    yield copy
+                elif pool is None:
+                    result = parseRead(filename, None, fileContent, cache, compact, stats, profile, st)
+                    parsed.setdefault(key, result)
+                    yield result
+                else:
+                    pending[key] = []
+                    pool.apply_async(
+                        parseReadWithStats, ( key, filename, fileContent, st, cache, compact, profile ), callback=finished.put
+                    )
+
+            if len(pending) == 0:
+                continue
+            key, filename, outbound, workerStats, error = finished.get()
+            if error is not None:
+                raise error
+            if stats is not None:
+                stats.merge(workerStats)
+            parsed.setdefault(key, ( filename, outbound ))
+            yield filename, outbound
+            for duplicate in pending.pop(key):
+                # A copy that can't be relabelled is rare enough to be read again
+                yield copyOf(key, duplicate) or parseOne(duplicate, cache, compact, stats, profile)
+    finally:
+        prefetched.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+            if cache is not None:
+                # The workers' copies of the cache don't keep it within its size
+                cache.checkSize()
+
+def parseFiles(files, workers=1, cache=None, compact=False, stats=None, prefetch=0, profile="full", dedup=False):
     """ Parse the files passed in as arguments, generate an uber-structure by filename
 
+        See iterParseFiles for workers, cache, compact, stats, prefetch and profile.  With dedup, identical
+        files are only parsed once (see iterDeduplicated).
+
         >>> res = parseFiles([ sys.argv[0] ])
         >>> './sunrise_parser.py' in res
         True
     """
     toReturn = {}
-    for filename in files:
-        fileContent = open(filename).read()
-        handleFile(filename, fileContent, toReturn)
+    parse = iterDeduplicated if dedup else iterParseFiles
+    for filename, outbound in parse(files, workers, cache, compact, stats, prefetch, profile):
+        toReturn[filename] = outbound
 
     return toReturn
 
-def parseFile(filename):
-    return parseFiles([filename])
+def parseFile(filename, cache=None, profile="full"):
+    return parseFiles([filename], cache=cache, profile=profile)
+
+def jsonLine(record):
+    """ Serialize a record as a single line of JSON.  Values that JSON can't represent (evaluated literals
+        with tuple keys and the like) are written as their repr.
+
+        >>> jsonLine({ "a" : [ 1, None ] })
+        '{"a": [1, null]}'
+        >>> jsonLine({ "value" : { (1, 2) : 3 } })
+        '{"value": "{(1, 2): 3}"}'
+    """
+    try:
+        return json.dumps(record, sort_keys=True, default=jsonDefault)
+    except (TypeError, ValueError):
+        record = dict(record)
+        for key in record.keys():
+            try:
+                json.dumps(record[key], default=jsonDefault)
+            except (TypeError, ValueError):
+                record[key] = repr(record[key])
+        return json.dumps(record, sort_keys=True, default=jsonDefault)
+
+def jsonDefault(value):
+    if isinstance(value, LazyLiteral):
+        return value.value
+    return repr(value)
+
+def iterCallSites(outbound):
+    """ Yield every call and assignment record of a file's outbound structure, tagged with its kind.
+
+        >>> outbound = handleFile("abc", "def foo():\\n    bar.baz(1)\\n", {})["abc"]
+        >>> [ ( site["kind"], site["method"] ) for site in iterCallSites(outbound) ]
+        [('call', ['bar', 'baz'])]
+    """
+    for clz in outbound["classes"]:
+        classInfo = outbound["classes"][clz]
+        for assignment in classInfo["assignments"]:
+            site = dict(expandRecord(assignment))
+            site["kind"] = "assignment"
+            yield site
+        for function in classInfo["functions"]:
+            for call in classInfo["functions"][function]["calls"]:
+                site = dict(expandRecord(call))
+                site["kind"] = "call"
+                yield site
+            for assignment in classInfo["functions"][function]["assignments"]:
+                site = dict(expandRecord(assignment))
+                site["kind"] = "assignment"
+                yield site
+
+def writeJsonLines(results, out, perCallSite=False):
+    """ Write ( filename, outbound ) pairs as JSON Lines, one record per file, or one per call/assignment site. """
+    for filename, outbound in results:
+        if perCallSite:
+            for site in iterCallSites(outbound):
+                out.write(jsonLine(site) + "\n")
+        else:
+            out.write(jsonLine({ "filename" : filename, "outbound" : expandOutbound(outbound) }) + "\n")
+        out.flush()
+
+def popArgument(args, flag, default=None):
+    """ Remove "flag value" from the argument list, returning the value (or default when absent).
+
+        >>> args = [ "--jobs", "4", "foo.py" ]
+        >>> popArgument(args, "--jobs")
+        '4'
+        >>> args
+        ['foo.py']
+        >>> popArgument(args, "--jobs", "1")
+        '1'
+    """
+    if flag not in args:
+        return default
+    pos = args.index(flag)
+    if pos + 1 >= len(args):
+        print "%s requires a value!" % flag
+        sys.exit(1)
+    value = args[pos + 1]
+    del args[pos:pos + 2]
+    return value
+
+def popArguments(args, flag):
+    """ Remove every "flag value" from the argument list, returning the values in order.
+
+        >>> args = [ "--exclude", "tests/", "foo", "--exclude", "*.pyc" ]
+        >>> popArguments(args, "--exclude"), args
+        (['tests/', '*.pyc'], ['foo'])
+    """
+    values = []
+    value = popArgument(args, flag)
+    while value is not None:
+        values.append(value)
+        value = popArgument(args, flag)
+    return values
 
 if __name__ == "__main__":
+    jobs = int(popArgument(sys.argv, "--jobs", "1"))
+    prefetch = int(popArgument(sys.argv, "--prefetch", "0"))
+    dedup = "--dedup" in sys.argv
+    if dedup:
+        sys.argv.remove("--dedup")
+    profile = popArgument(sys.argv, "--profile", "full")
+    if profile not in PROFILES:
+        print "--profile must be one of %s" % ", ".join(sorted(PROFILES.keys()))
+        sys.exit(1)
+    include = popArguments(sys.argv, "--include")
+    exclude = popArguments(sys.argv, "--exclude")
+    jsonl = None
+    for flag in ( "--jsonl", "--jsonl-calls" ):
+        if flag in sys.argv:
+            sys.argv.remove(flag)
+            jsonl = flag
+    compact = "--compact" in sys.argv
+    if compact:
+        sys.argv.remove("--compact")
+    stats = None
+    if "--stats" in sys.argv:
+        sys.argv.remove("--stats")
+        stats = ParseStats()
+    spillDir = popArgument(sys.argv, "--spill")
+    binaryPath = popArgument(sys.argv, "--binary")
+    memoryBudget = int(popArgument(sys.argv, "--memory-budget", "64")) * 1024 * 1024
+    cache = None
+    cacheDir = popArgument(sys.argv, "--cache")
+    if cacheDir is not None:
+        import parse_cache
+        cache = parse_cache.ParseCache(cacheDir)
+
     if len(sys.argv) < 2:
         print "At least one filename or directory required!"
         sys.exit(1)
@@ -514,7 +1451,7 @@ if __name__ == "__main__":
         if len(sys.argv) == 4:
             classToDebug = sys.argv[3]
 
-        result = parseFiles([sys.argv[1]])
+        result = parseFiles([sys.argv[1]], cache=cache)
         for filename in result:
             for clz in result[filename]["classes"]:
                 if clz == classToDebug:
@@ -524,5 +1461,28 @@ if __name__ == "__main__":
                     print clz
         sys.exit(0)
 
-    result = parseFiles(sys.argv[1:])
-    pprint(result)
+    import file_walker
+    files = file_walker.walkFiles(sys.argv[1:], include or file_walker.DEFAULT_INCLUDE, exclude)
+    parse = iterDeduplicated if dedup else iterParseFiles
+
+    if spillDir is not None:
+        import spill_store
+        writer = spill_store.ShardWriter(spillDir, memoryBudget)
+        for filename, outbound in parse(files, workers=jobs, cache=cache, compact=compact, stats=stats, prefetch=prefetch, profile=profile):
+            writer.add(filename, outbound)
+        for filename, outbound in writer.close().iteritems():
+            pprint({ filename : outbound })
+    elif binaryPath is not None:
+        import binary_result
+        binary_result.writeResults(
+            parse(files, workers=jobs, cache=cache, compact=compact, stats=stats, prefetch=prefetch, profile=profile), binaryPath
+        )
+    elif jsonl is not None:
+        results = parse(files, workers=jobs, cache=cache, compact=compact, stats=stats, prefetch=prefetch, profile=profile)
+        writeJsonLines(results, sys.stdout, jsonl == "--jsonl-calls")
+    else:
+        result = parseFiles(files, workers=jobs, cache=cache, compact=compact, stats=stats, prefetch=prefetch, profile=profile, dedup=dedup)
+        pprint(result)
+
+    if stats is not None:
+        sys.stderr.write(stats.formatReport() + "\n")
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for ast_parser, inherits_from and import_resolver over a generated, synthetic tree.
+
+The generated tree is a package of modules with many classes, deep inheritance chains (each module's classes
+inherit from the previous module's, the first module of each chain from synthetic.base.Root), dense call sites,
+and heavy imports (of stdlib modules and of sibling modules).  inherits_from is asked for the subclasses of
+base.Root (of object for a --corpus), so each level of the chains is one more round of its prefilter.  The
+imports are resolved both by the original pkgutil based figureOutFilenameForModule and by StaticResolver.  Every phase runs in its own child process, so the memory reported is that phase's alone.
+
+The report is JSON: for each phase the wall time, files/s, AST nodes/s and memory, in KB:
+
+    peak_rss_kb            how far the phase's process grew above its RSS when the phase started
+    workers_peak_rss_kb    the peak RSS of the largest of the worker processes it started (--jobs), if any
+
+Examples:
+
+./benchmark.py --files 500 --classes 10 --depth 20
+./benchmark.py --files 2000 --jobs 4 --output bench_output.txt
+./benchmark.py --corpus /opt/stack/nova/nova
+"""
+
+import ast
+import json
+import multiprocessing
+import os
+import Queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import ast_parser
+import import_resolver
+import inherits_from
+
+STDLIB_IMPORTS = [ "os", "sys", "json", "logging", "collections", "os.path", "xml.dom.minidom", "email.mime.text" ]
+
+ROOT_BASE = "base.Root"
+
+def generateModule(index, classes, depth, calls, imports, rand):
+    """ Source of one synthetic module.  Class k of module n is Class<n>_<k>, and inherits (by its bare name,
+        the way inherits_from follows a chain) from class k of module n - 1, or from base.Root.
+
+        >>> source = generateModule(3, 2, 2, 2, 2, random.Random(1))
+        >>> tree = ast.parse(source)
+        >>> [ ( node.name, node.bases[0].id ) for node in tree.body if isinstance(node, ast.ClassDef) ]
+        [('Class3_0', 'Class2_0'), ('Class3_1', 'Class2_1')]
+    """
+    lines = []
+    for pos in range(imports):
+        lines.append("import %s" % STDLIB_IMPORTS[pos % len(STDLIB_IMPORTS)])
+    if index > 0:
+        # Inheritance chains of length depth: module n extends module n - 1, restarting every depth modules
+        parent = index - 1 if index % depth != 0 else None
+    else:
+        parent = None
+    if parent is not None:
+        lines.append("from synthetic.mod%d import %s" % ( parent, ", ".join([ "Class%d_%d" % ( parent, clz ) for clz in range(classes) ]) ))
+    else:
+        lines.append("from synthetic import base")
+    lines.append("")
+    lines.append("CONFIG = { 'name' : 'mod%d', 'values' : [ 1, 2, 3 ] }" % index)
+    lines.append("")
+
+    for clz in range(classes):
+        if parent is not None:
+            base = "Class%d_%d" % ( parent, clz )
+        else:
+            base = ROOT_BASE
+        lines.append("class Class%d_%d(%s):" % ( index, clz, base ))
+        lines.append("    table = 'table_%d_%d'" % ( index, clz ))
+        lines.append("")
+        lines.append("    def __init__(self, db, ctx):")
+        lines.append("        self.db = db")
+        lines.append("        self.ctx = ctx")
+        lines.append("        self.api = db.api")
+        lines.append("")
+        for method in range(3):
+            lines.append("    def method%d(self, arg, *args, **kwargs):" % method)
+            for call in range(calls):
+                choice = rand.randint(0, 3)
+                if choice == 0:
+                    lines.append("        result = self.db.api.instance_get(self.ctx, arg, %d)" % call)
+                elif choice == 1:
+                    lines.append("        self.session.query(self.table).filter_by(id=arg).first()")
+                elif choice == 2:
+                    lines.append("        os.path.join(self.ctx.path, str(arg), 'x%d')" % call)
+                else:
+                    lines.append("        logging.debug('call %%s', self.api.get(arg, self.ctx))")
+            lines.append("        return arg")
+            lines.append("")
+    return "\n".join(lines) + "\n"
+
+def generateCorpus(targetDir, files=200, classes=5, depth=10, calls=10, imports=6, seed=0):
+    """ Write a synthetic package ("synthetic") of files modules below targetDir, returning the module paths """
+    rand = random.Random(seed)
+    packageDir = os.path.join(targetDir, "synthetic")
+    if not os.path.isdir(packageDir):
+        os.makedirs(packageDir)
+    open(os.path.join(packageDir, "__init__.py"), "w").write("")
+    open(os.path.join(packageDir, "base.py"), "w").write("class Root(object):\n    pass\n")
+
+    filenames = []
+    for index in range(files):
+        filename = os.path.join(packageDir, "mod%d.py" % index)
+        with open(filename, "w") as fh:
+            fh.write(generateModule(index, classes, depth, calls, imports, rand))
+        filenames.append(filename)
+    return filenames
+
+def countNodes(filenames):
+    total = 0
+    for filename in filenames:
+        for node in ast.walk(ast.parse(open(filename).read())):
+            total += 1
+    return total
+
+def benchParseFiles(corpus, options):
+    ast_parser.parseFiles(corpus["files"], workers=options["jobs"])
+
+def benchInheritsFrom(corpus, options):
+    inherits_from.handle(corpus["root"], [ corpus["rootBase"] ], workers=options["jobs"])
+
+def benchPkgutilResolver(corpus, options):
+    # pkgutil only finds what is on sys.path, this runs in its own process
+    sys.path.insert(0, corpus["root"])
+    import_resolver.resolveImports(corpus["files"], import_resolver.figureOutFilenameForModule)
+
+def benchStaticResolver(corpus, options):
+    resolver = import_resolver.StaticResolver([ corpus["root"] ])
+    import_resolver.resolveImports(corpus["files"], resolver.resolve)
+
+PHASES = [
+    ( "parseFiles", benchParseFiles ),
+    ( "inherits_from.handle", benchInheritsFrom ),
+    ( "import_resolver.figureOutFilenameForModule", benchPkgutilResolver ),
+    ( "import_resolver.StaticResolver", benchStaticResolver ),
+]
+
+def maxRss(who):
+    """ ru_maxrss in kilobytes (it is kilobytes on Linux, bytes on OS X) """
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return peak
+
+def runPhase(phase, corpus, options, queue):
+    """ The body of the child process: ( "ok", elapsed, peak, workersPeak ), or ( "error", traceback ) on queue """
+    try:
+        # What the child inherited from the parent isn't the phase's
+        before = maxRss(resource.RUSAGE_SELF)
+        start = time.time()
+        phase(corpus, options)
+        elapsed = time.time() - start
+        queue.put(( "ok", elapsed, maxRss(resource.RUSAGE_SELF) - before, maxRss(resource.RUSAGE_CHILDREN) ))
+    except BaseException:
+        queue.put(( "error", traceback.format_exc().strip() ))
+
+def waitResult(child, queue, poll=1):
+    """ What the child put on queue, without waiting forever for a child that died before putting anything """
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Queue.Empty:
+            if not child.is_alive():
+                try:
+                    return queue.get(timeout=poll)
+                except Queue.Empty:
+                    return ( "error", "exited with code %s" % child.exitcode )
+
+def measure(name, phase, corpus, options):
+    """ Run a phase in a child process (best of options["repeat"] runs) and report its throughput
+
+        >>> def broken(corpus, options):
+        ...     raise ValueError("no corpus")
+        >>> measure("broken", broken, { "files" : [], "nodes" : 0 }, { "repeat" : 1 }) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        Exception: broken failed: Traceback (most recent call last):...ValueError: no corpus
+    """
+    best = None
+    for run in range(options["repeat"]):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=runPhase, args=( phase, corpus, options, queue ))
+        child.start()
+        result = waitResult(child, queue)
+        child.join()
+        if result[0] == "error":
+            raise Exception("%s failed: %s" % ( name, result[1] ))
+        if best is None or result[1] < best[0]:
+            best = result[1:]
+
+    elapsed, peak, workersPeak = best
+    return {
+        "phase" : name,
+        "seconds" : round(elapsed, 4),
+        "files_per_second" : round(len(corpus["files"]) / elapsed, 2) if elapsed > 0 else None,
+        "nodes_per_second" : round(corpus["nodes"] / elapsed, 2) if elapsed > 0 else None,
+        "peak_rss_kb" : peak,
+        "workers_peak_rss_kb" : workersPeak
+    }
+
+def runBenchmarks(options):
+    corpusDir = None
+    rootBase = ROOT_BASE
+    if options["corpus"] is not None:
+        root = options["corpus"]
+        files = inherits_from.findPythonFiles(root)
+        rootBase = "object"
+    else:
+        corpusDir = tempfile.mkdtemp(prefix="ast_utils_bench")
+        root = corpusDir
+        files = generateCorpus(
+            corpusDir, options["files"], options["classes"], options["depth"], options["calls"], options["imports"]
+        )
+
+    try:
+        corpus = { "root" : root, "rootBase" : rootBase, "files" : files, "nodes" : countNodes(files) }
+        report = {
+            "parser_version" : ast_parser.PARSER_VERSION,
+            "options" : options,
+            "corpus" : { "files" : len(files), "nodes" : corpus["nodes"], "bytes" : sum([ os.path.getsize(f) for f in files ]) },
+            "phases" : []
+        }
+        for name, phase in PHASES:
+            report["phases"].append(measure(name, phase, corpus, options))
+        return report
+    finally:
+        if corpusDir is not None:
+            shutil.rmtree(corpusDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    options = {
+        "files" : int(ast_parser.popArgument(sys.argv, "--files", "200")),
+        "classes" : int(ast_parser.popArgument(sys.argv, "--classes", "5")),
+        "depth" : int(ast_parser.popArgument(sys.argv, "--depth", "10")),
+        "calls" : int(ast_parser.popArgument(sys.argv, "--calls", "10")),
+        "imports" : int(ast_parser.popArgument(sys.argv, "--imports", "6")),
+        "jobs" : int(ast_parser.popArgument(sys.argv, "--jobs", "1")),
+        "repeat" : int(ast_parser.popArgument(sys.argv, "--repeat", "1")),
+        "corpus" : ast_parser.popArgument(sys.argv, "--corpus"),
+    }
+    output = ast_parser.popArgument(sys.argv, "--output")
+
+    report = json.dumps(runBenchmarks(options), indent=4, sort_keys=True)
+    if output is not None:
+        open(output, "w").write(report + "\n")
+    print report
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""
+A compact binary file format for parse results, written one file at a time as they are parsed, and read back
+one file (or one class) at a time without decoding the rest.
+
+Layout:
+
+    MAGIC
+    one record per parsed file:   <length> <imports> <class directory> <class> <class> ...
+    trailer:                      marshal of { string table, file index, class index }
+    <trailer offset> MAGIC
+
+Every string in the records is an index into the string table (method paths, filenames and class names repeat
+endlessly), the class directory gives each class' offset and length within its file record, the file index
+each record's offset and length, and the class index which files define a class of that name.
+
+Examples:
+
+./ast_parser.py --binary /tmp/nova.astr /opt/stack/nova/nova
+./binary_result.py list /tmp/nova.astr
+./binary_result.py show /tmp/nova.astr /opt/stack/nova/nova/db/api.py
+./binary_result.py class /tmp/nova.astr ComputeManager
+"""
+
+import marshal
+import struct
+import sys
+from UserDict import DictMixin
+
+import ast_parser
+
+MAGIC = "ASTRES1\n"
+FORMAT_VERSION = 1
+
+UINT = struct.Struct("<I")
+INT = struct.Struct("<i")
+LONG = struct.Struct("<q")
+DOUBLE = struct.Struct("<d")
+OFFSET = struct.Struct("<Q")
+ENTRY = struct.Struct("<III")
+
+class Encoder(object):
+    """
+        Encodes values into tagged binary, the strings going into a string table shared by every record.
+
+        >>> encoder = Encoder()
+        >>> data = encoder.encode({ "a" : [ 1, None, ( "a", 2.5 ), u"\\xe9", True, 2 ** 40 ] })
+        >>> Decoder(encoder.strings).decode(data)
+        {'a': [1, None, ('a', 2.5), u'\\xe9', True, 1099511627776]}
+        >>> encoder.strings
+        ['a', '\\xc3\\xa9']
+    """
+    def __init__(self):
+        self.strings = []
+        self.stringIds = {}
+
+    def stringId(self, value):
+        stringId = self.stringIds.get(value)
+        if stringId is None:
+            stringId = len(self.strings)
+            self.strings.append(value)
+            self.stringIds[value] = stringId
+        return stringId
+
+    def encode(self, value):
+        chunks = []
+        self.encodeInto(value, chunks)
+        return "".join(chunks)
+
+    def encodeInto(self, value, chunks):
+        cls = value.__class__
+        if cls is str:
+            chunks.append("s" + UINT.pack(self.stringId(value)))
+        elif cls is dict:
+            chunks.append("D" + UINT.pack(len(value)))
+            for key, item in value.iteritems():
+                self.encodeInto(key, chunks)
+                self.encodeInto(item, chunks)
+        elif cls is list or cls is tuple:
+            chunks.append(( "l" if cls is list else "t" ) + UINT.pack(len(value)))
+            for item in value:
+                self.encodeInto(item, chunks)
+        elif value is None:
+            chunks.append("N")
+        elif cls is bool:
+            chunks.append("T" if value else "F")
+        elif cls is int and -2 ** 31 <= value < 2 ** 31:
+            chunks.append("i" + INT.pack(value))
+        elif ( cls is int or cls is long ) and -2 ** 63 <= value < 2 ** 63:
+            chunks.append("q" + LONG.pack(value))
+        elif cls is float:
+            chunks.append("d" + DOUBLE.pack(value))
+        elif cls is unicode:
+            chunks.append("u" + UINT.pack(self.stringId(value.encode("utf-8"))))
+        elif cls is ast_parser.LazyLiteral:
+            self.encodeInto(value.value, chunks)
+        else:
+            # Whatever else a literal evaluated to (sets, huge numbers...), like jsonLine does
+            chunks.append("s" + UINT.pack(self.stringId(repr(value))))
+
+class Decoder(object):
+    """ Decodes what Encoder produced, given its string table """
+    def __init__(self, strings):
+        self.strings = strings
+
+    def decode(self, data, pos=0):
+        value, pos = self.decodeAt(data, pos)
+        return value
+
+    def decodeAt(self, data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == "s":
+            return self.strings[UINT.unpack_from(data, pos)[0]], pos + 4
+        elif tag == "D":
+            count = UINT.unpack_from(data, pos)[0]
+            pos += 4
+            value = {}
+            for item in xrange(count):
+                key, pos = self.decodeAt(data, pos)
+                value[key], pos = self.decodeAt(data, pos)
+            return value, pos
+        elif tag == "l" or tag == "t":
+            count = UINT.unpack_from(data, pos)[0]
+            pos += 4
+            value = []
+            for item in xrange(count):
+                item, pos = self.decodeAt(data, pos)
+                value.append(item)
+            return ( value if tag == "l" else tuple(value) ), pos
+        elif tag == "N":
+            return None, pos
+        elif tag == "T":
+            return True, pos
+        elif tag == "F":
+            return False, pos
+        elif tag == "i":
+            return INT.unpack_from(data, pos)[0], pos + 4
+        elif tag == "q":
+            return LONG.unpack_from(data, pos)[0], pos + 8
+        elif tag == "d":
+            return DOUBLE.unpack_from(data, pos)[0], pos + 8
+        elif tag == "u":
+            return self.strings[UINT.unpack_from(data, pos)[0]].decode("utf-8"), pos + 4
+        raise ValueError("bad tag %r at %d" % ( tag, pos - 1 ))
+
+class ResultWriter(object):
+    """
+        Streams ( filename, outbound ) pairs into a binary result file.  Only the string table and the indexes
+        are kept in memory.
+    """
+    def __init__(self, path):
+        self.fh = open(path, "wb")
+        self.fh.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.encoder = Encoder()
+        self.files = {}
+        self.classes = {}
+
+    def add(self, filename, outbound):
+        outbound = ast_parser.expandOutbound(outbound)
+        imports = self.encoder.encode(outbound["imports"])
+        directory = []
+        blobs = []
+        classOffset = 0
+        for clz, classInfo in outbound["classes"].iteritems():
+            blob = self.encoder.encode(classInfo)
+            directory.append(ENTRY.pack(self.encoder.stringId(clz), classOffset, len(blob)))
+            blobs.append(blob)
+            classOffset += len(blob)
+            self.classes.setdefault(clz, []).append(filename)
+
+        record = "".join([ UINT.pack(len(imports)), imports, UINT.pack(len(directory)) ] + directory + blobs)
+        self.fh.write(UINT.pack(len(record)))
+        self.fh.write(record)
+        self.files[filename] = ( self.offset + UINT.size, len(record) )
+        self.offset += UINT.size + len(record)
+
+    def close(self):
+        trailer = marshal.dumps({
+            "format" : FORMAT_VERSION,
+            "version" : ast_parser.PARSER_VERSION,
+            "strings" : self.encoder.strings,
+            "files" : self.files,
+            "classes" : self.classes
+        })
+        self.fh.write(trailer)
+        self.fh.write(OFFSET.pack(self.offset))
+        self.fh.write(MAGIC)
+        self.fh.close()
+
+class ResultReader(DictMixin):
+    """
+        A binary result file, as a read-only filename -> outbound mapping.  Only the trailer is loaded up front,
+        each file (or class) is read and decoded when it is asked for.
+
+        >>> import os, tempfile
+        >>> fd, path = tempfile.mkstemp()
+        >>> results = ast_parser.parseFiles([ sys.argv[0], ast_parser.__file__.replace(".pyc", ".py") ])
+        >>> writeResults(results.iteritems(), path)
+        >>> reader = ResultReader(path)
+        >>> sorted(reader.keys()) == sorted(results.keys())
+        True
+        >>> reader[sys.argv[0]] == results[sys.argv[0]]
+        True
+        >>> reader.loadClass(sys.argv[0], "ResultReader") == results[sys.argv[0]]["classes"]["ResultReader"]
+        True
+        >>> reader.findClass("FuncLister").keys() == [ ast_parser.__file__.replace(".pyc", ".py") ]
+        True
+        >>> reader.close(); os.close(fd); os.remove(path)
+    """
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        if self.fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary result file" % path)
+        self.fh.seek(-( OFFSET.size + len(MAGIC) ), 2)
+        end = self.fh.tell()
+        trailerOffset = OFFSET.unpack(self.fh.read(OFFSET.size))[0]
+        if self.fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is truncated" % path)
+        self.fh.seek(trailerOffset)
+        trailer = marshal.loads(self.fh.read(end - trailerOffset))
+        if trailer["format"] != FORMAT_VERSION:
+            raise ValueError("%s is format %s, not %s" % ( path, trailer["format"], FORMAT_VERSION ))
+        self.version = trailer["version"]
+        self.files = trailer["files"]
+        self.classes = trailer["classes"]
+        self.decoder = Decoder(trailer["strings"])
+
+    def readRecord(self, filename):
+        offset, length = self.files[filename]
+        self.fh.seek(offset)
+        return self.fh.read(length)
+
+    def classDirectory(self, record):
+        """ { class : ( offset, length ) } of a file record, offsets being within the record """
+        importsLength = UINT.unpack_from(record, 0)[0]
+        pos = UINT.size + importsLength
+        count = UINT.unpack_from(record, pos)[0]
+        pos += UINT.size
+        start = pos + count * ENTRY.size
+        directory = {}
+        for entry in xrange(count):
+            nameId, offset, length = ENTRY.unpack_from(record, pos)
+            directory[self.decoder.strings[nameId]] = ( start + offset, length )
+            pos += ENTRY.size
+        return directory
+
+    def __getitem__(self, filename):
+        record = self.readRecord(filename)
+        outbound = { "imports" : self.decoder.decode(record, UINT.size), "classes" : {} }
+        for clz, ( offset, length ) in self.classDirectory(record).iteritems():
+            outbound["classes"][clz] = self.decoder.decode(record, offset)
+        return outbound
+
+    def loadClass(self, filename, clz):
+        """ The structure of one class of one file, nothing else of the file gets decoded """
+        record = self.readRecord(filename)
+        offset, length = self.classDirectory(record)[clz]
+        return self.decoder.decode(record, offset)
+
+    def findClass(self, clz):
+        """ { filename : class structure } for every file defining a class named clz """
+        return dict([ ( filename, self.loadClass(filename, clz) ) for filename in self.classes.get(clz, []) ])
+
+    def keys(self):
+        return self.files.keys()
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def iteritems(self):
+        """ Every ( filename, outbound ), in file order """
+        for offset, filename in sorted([ ( offset, filename ) for filename, ( offset, length ) in self.files.iteritems() ]):
+            yield filename, self[filename]
+
+    def close(self):
+        self.fh.close()
+
+def writeResults(results, path):
+    """ Write the ( filename, outbound ) pairs of results (iterParseFiles, say) to path as they come """
+    writer = ResultWriter(path)
+    for filename, outbound in results:
+        writer.add(filename, outbound)
+    writer.close()
+
+def usage():
+    print "usage: binary_result.py list RESULT"
+    print "       binary_result.py show RESULT [FILENAME [CLASS]]"
+    print "       binary_result.py class RESULT CLASS"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    if len(sys.argv) < 3:
+        usage()
+
+    from pprint import pprint
+    reader = ResultReader(sys.argv[2])
+    command = sys.argv[1]
+    if command == "list":
+        for filename in sorted(reader.keys()):
+            print filename
+    elif command == "show" and len(sys.argv) == 3:
+        for filename, outbound in reader.iteritems():
+            pprint({ filename : outbound })
+    elif command == "show" and len(sys.argv) == 4:
+        pprint(reader[sys.argv[3]])
+    elif command == "show" and len(sys.argv) == 5:
+        pprint(reader.loadClass(sys.argv[3], sys.argv[4]))
+    elif command == "class" and len(sys.argv) == 4:
+        pprint(reader.findClass(sys.argv[3]))
+    else:
+        usage()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+
+"""
+A cross-file call graph built from the ast_parser output of a tree, and reachability queries over it: which
+sink calls (database calls, say) can be reached from a set of entry functions (API calls, say).
+
+Calls are resolved statically, using what the parser recorded:
+
+    self.foo()              a method of the class, or of one of the classes it inheritsFrom
+    self.x.y()              x is looked up in the assignments to self.x, ie: self.x = compute.API()
+    name.y() / name()       a local or module level assignment, a function or class of the module, or an import
+    module.Class.method()   followed through the modules of the tree, and what they import in turn
+
+The graph is condensed into strongly connected components, and the sinks reachable from each component are
+computed once, so any number of entry points can be queried in a single linear pass.
+
+Function names are "module:Class.function" (or "module:function" for module level functions), sink patterns
+are fnmatch patterns matched against the call as written (self.db.instance_get), the call with its first name
+expanded through the imports (nova.db.api.instance_get), and the function it resolved to.
+
+Examples:
+
+./call_graph.py /opt/stack/nova --entry 'nova.api.openstack.compute.servers:*' --sink '*.db.api.*' --sink '*session.query'
+"""
+
+import fnmatch
+import json
+import os
+import sys
+
+import ast_parser
+import call_index
+import file_walker
+import parse_cache
+
+MAX_DEPTH = 12
+
+def moduleName(filename, root):
+    """
+        >>> moduleName("/opt/stack/nova/nova/db/api.py", "/opt/stack/nova")
+        'nova.db.api'
+        >>> moduleName("/opt/stack/nova/nova/db/__init__.py", "/opt/stack/nova")
+        'nova.db'
+    """
+    relative = os.path.relpath(os.path.abspath(filename), os.path.abspath(root))
+    parts = os.path.splitext(relative)[0].split(os.sep)
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join(parts)
+
+def assignmentTarget(record):
+    """ The target of an assignment record.  Attribute/string assignments are recorded with their positional
+        fields shifted by one, which leaves the target in col_offset. """
+    if isinstance(record["col_offset"], list):
+        return record["col_offset"]
+    return record["target"]
+
+def stringPath(path):
+    """ The leading names of a path, up to the first call within it (foo().bar -> [ 'foo' ] is not a name path) """
+    if not isinstance(path, list):
+        return None
+    for item in path:
+        if not isinstance(item, basestring):
+            return None
+    return path
+
+class CallGraph(object):
+    """
+        >>> files = {
+        ...     "/t/app/api.py" : "from app import db\\nclass API(object):\\n    def __init__(self):\\n        self.db = db.Driver()\\n    def get(self, ctx):\\n        return self.lookup(ctx)\\n    def lookup(self, ctx):\\n        return self.db.fetch(ctx)\\n",
+        ...     "/t/app/db.py" : "class Driver(object):\\n    def fetch(self, ctx):\\n        return session.query(ctx)\\n",
+        ... }
+        >>> parsed = dict([ ( name, ast_parser.handleFile(name, source, {})[name] ) for name, source in files.items() ])
+        >>> graph = CallGraph(parsed, "/t")
+        >>> sorted(graph.edges["app.api:API.lookup"])
+        ['app.db:Driver.fetch']
+        >>> result = graph.reachableSinks([ "app.api:API.get" ], [ "session.query" ])
+        >>> result["app.api:API.get"]
+        ['/t/app/db.py:3 session.query']
+
+        The edges don't depend on the order the nodes are visited in, even when resolving goes around a cycle
+        (h1.conn and h2.backup are defined in terms of each other):
+
+        >>> def edgesWithin(name):
+        ...     files = {
+        ...         "/t/h1.py" : "import h2\\nconn = h2.backup\\n",
+        ...         "/t/h2.py" : "import h1\\nimport h3\\nbackup = h1.conn\\nbackup = h3.Session()\\nalias = h1.conn\\n",
+        ...         "/t/h3.py" : "class Session(object):\\n    def query(self, q):\\n        return session.query(q)\\n",
+        ...         "/t/h4.py" : "import h1\\ndef e():\\n    return h1.conn.query(1)\\n",
+        ...         "/t/%s.py" % name : "import h2\\nclass K(object):\\n    def run(self):\\n        return h2.alias.query(1)\\n",
+        ...     }
+        ...     parsed = dict([ ( filename, ast_parser.handleFile(filename, source, {})[filename] ) for filename, source in files.items() ])
+        ...     return sorted(CallGraph(parsed, "/t").edges["%s:K.run" % name])
+        >>> edgesWithin("k"), edgesWithin("x")
+        (['h3:Session.query'], ['h3:Session.query'])
+    """
+    def __init__(self, parsed, root):
+        self.parsed = parsed
+        self.modules = {}    # module name -> filename
+        self.nodes = {}      # node id -> ( module, class, function )
+        self.edges = {}      # node id -> set of node ids
+        self.sites = {}      # node id -> [ ( forms, description ) ]
+        self.imports = {}    # module name -> { name : dotted path }
+        self.memo = {}
+        self.mroMemo = {}
+        self.resolving = set()
+        self.truncated = 0   # bumped whenever a result is cut short (depth, cycle) and so must not be memoized
+
+        for filename in parsed.keys():
+            module = moduleName(filename, root)
+            self.modules[module] = filename
+            imports = {}
+            for clz in parsed[filename]["imports"]:
+                imports.update(parsed[filename]["imports"][clz])
+            self.imports[module] = imports
+
+        for module, filename in self.modules.iteritems():
+            for clz, classInfo in parsed[filename]["classes"].iteritems():
+                for function in classInfo["functions"]:
+                    self.nodes[self.nodeId(module, clz, function)] = ( module, clz, function )
+
+        for nodeId in sorted(self.nodes):
+            self.addEdges(nodeId)
+
+    # Naming
+
+    def basename(self, module):
+        return ast_parser.getBasenameFromFilename(self.modules[module])
+
+    def isRealClass(self, module, clz):
+        return clz != self.basename(module) and clz in self.parsed[self.modules[module]]["classes"]
+
+    def nodeId(self, module, clz, function):
+        if clz == ast_parser.getBasenameFromFilename(self.modules[module]):
+            return "%s:%s" % ( module, function )
+        return "%s:%s.%s" % ( module, clz, function )
+
+    def classInfo(self, module, clz):
+        return self.parsed[self.modules[module]]["classes"].get(clz)
+
+    # Resolution, every target is a tuple: ( "module", m ), ( "class", m, c ), ( "instance", m, c ), ( "function", nodeId )
+
+    def resolveDotted(self, dotted, depth):
+        """ A dotted path (from an import) to a target within the tree """
+        parts = dotted.split(".")
+        for pos in range(len(parts), 0, -1):
+            prefix = ".".join(parts[:pos])
+            if prefix in self.modules:
+                return self.follow(( "module", prefix ), parts[pos:], depth + 1)
+        return None
+
+    def follow(self, target, names, depth):
+        for name in names:
+            if target is None:
+                return None
+            target = self.attribute(target, name, depth + 1)
+        return target
+
+    def findMethod(self, module, clz, name, depth):
+        for baseModule, baseClass in self.mro(module, clz, depth):
+            if name in self.classInfo(baseModule, baseClass)["functions"]:
+                return ( "function", self.nodeId(baseModule, baseClass, name) )
+        return None
+
+    def mro(self, module, clz, depth=0):
+        """ The class and the classes it inherits from (that live in the tree), depth first """
+        key = ( module, clz )
+        if key in self.mroMemo:
+            return self.mroMemo[key]
+        if ( "mro", key ) in self.resolving: # an inheritance cycle
+            self.truncated += 1
+            return [ key ]
+
+        truncated = self.truncated
+        self.resolving.add(( "mro", key ))
+        order = [ key ]
+        scope = ( module, None, None )
+        try:
+            for base in self.classInfo(module, clz)["inheritsFrom"]:
+                target = self.resolveTarget(stringPath(base), scope, depth + 1)
+                if target is not None and target[0] == "class":
+                    for item in self.mro(target[1], target[2], depth + 1):
+                        if item not in order:
+                            order.append(item)
+        finally:
+            self.resolving.discard(( "mro", key ))
+        if self.truncated == truncated:
+            self.mroMemo[key] = order
+        return order
+
+    def attribute(self, target, name, depth):
+        if depth > MAX_DEPTH:
+            self.truncated += 1
+            return None
+
+        kind = target[0]
+        if kind == "module":
+            module = target[1]
+            if "%s.%s" % ( module, name ) in self.modules:
+                return ( "module", "%s.%s" % ( module, name ) )
+            return self.lookupModuleName(module, name, depth)
+
+        if kind in ( "class", "instance" ):
+            module, clz = target[1], target[2]
+            method = self.findMethod(module, clz, name, depth)
+            if method is not None:
+                return method
+            for baseModule, baseClass in self.mro(module, clz, depth):
+                value = self.assignedValue(baseModule, baseClass, [ "self", name ], depth)
+                if value is not None:
+                    return value
+                value = self.assignedValue(baseModule, baseClass, [ name ], depth, classLevel=True)
+                if value is not None:
+                    return value
+        return None
+
+    def lookupModuleName(self, module, name, depth):
+        """ A name used at the top level of a module: a function, a class, an import or an assignment """
+        filename = self.modules[module]
+        classes = self.parsed[filename]["classes"]
+        basename = self.basename(module)
+
+        if name in classes[basename]["functions"]:
+            return ( "function", self.nodeId(module, basename, name) )
+        if name != basename and name in classes:
+            return ( "class", module, name )
+        if name in self.imports[module]:
+            return self.resolveDotted(self.imports[module][name], depth + 1)
+        return self.valueOf(classes[basename]["assignments"], [ name ], ( module, None, None ), depth)
+
+    def assignedValue(self, module, clz, target, depth, classLevel=False):
+        """ The value assigned to target (ie: [ 'self', 'db' ]) anywhere in the class """
+        classInfo = self.classInfo(module, clz)
+        scope = ( module, clz, None )
+        if classLevel:
+            return self.valueOf(classInfo["assignments"], target, scope, depth)
+        for function in classInfo["functions"].itervalues():
+            value = self.valueOf(function["assignments"], target, scope, depth)
+            if value is not None:
+                return value
+        return None
+
+    def valueOf(self, assignments, target, scope, depth):
+        for record in assignments:
+            if assignmentTarget(record) != target:
+                continue
+            path = stringPath(record["method"])
+            if path is None:
+                continue
+            value = self.resolveTarget(path, scope, depth + 1)
+            if value is None:
+                continue
+            if isinstance(record["col_offset"], list):
+                return value # foo = thing.other, an alias
+            if value[0] == "class":
+                return ( "instance", value[1], value[2] ) # foo = Thing(), an instance
+        return None
+
+    def resolveTarget(self, path, scope, depth=0):
+        """ What a name path refers to within scope ( module, class, function ) """
+        if path is None or len(path) == 0:
+            return None
+        if depth > MAX_DEPTH:
+            self.truncated += 1
+            return None
+
+        key = ( scope, tuple(path) )
+        if key in self.memo:
+            return self.memo[key]
+        if key in self.resolving: # a self.x = self.x.foo() style loop
+            self.truncated += 1
+            return None
+
+        # Only results that were resolved in full are memoized: one that was cut short by MAX_DEPTH or by a
+        # loop depends on where the resolution started, and another start may well get further.
+        truncated = self.truncated
+        self.resolving.add(key)
+        try:
+            module, clz, function = scope
+            head = path[0]
+            target = None
+            if head == "self" and clz is not None and self.isRealClass(module, clz):
+                target = ( "instance", module, clz )
+            else:
+                if function is not None:
+                    functionInfo = self.classInfo(module, clz)["functions"][function]
+                    target = self.valueOf(functionInfo["assignments"], [ head ], scope, depth)
+                if target is None:
+                    target = self.lookupModuleName(module, head, depth)
+
+            if target is not None:
+                target = self.follow(target, path[1:], depth)
+        finally:
+            self.resolving.discard(key)
+        if self.truncated == truncated:
+            self.memo[key] = target
+        return target
+
+    def resolveCall(self, path, scope):
+        """ The node id a call lands in, if it can be resolved """
+        target = self.resolveTarget(stringPath(path), scope)
+        if target is None:
+            return None
+        if target[0] == "function":
+            return target[1]
+        if target[0] == "class":
+            method = self.findMethod(target[1], target[2], "__init__", 0)
+            if method is not None:
+                return method[1]
+        return None
+
+    # Graph
+
+    def addEdges(self, nodeId):
+        module, clz, function = self.nodes[nodeId]
+        filename = self.modules[module]
+        scope = ( module, clz, function )
+        imports = self.imports[module]
+        edges = self.edges.setdefault(nodeId, set())
+        sites = self.sites.setdefault(nodeId, [])
+
+        for call in self.classInfo(module, clz)["functions"][function]["calls"]:
+            if not isinstance(call["method"], list) or len(call["method"]) == 0:
+                continue
+
+            components = call_index.pathComponents(call["method"])
+            forms = [ ".".join(components) ]
+            if components[0] in imports:
+                forms.append(".".join(imports[components[0]].split(".") + components[1:]))
+
+            callee = self.resolveCall(call["method"], scope)
+            if callee is not None:
+                edges.add(callee)
+                forms.append(callee)
+
+            lineno, col_offset = call_index.siteLocation(call)
+            sites.append(( forms, "%s:%s %s" % ( filename, lineno, forms[0] ) ))
+
+    def components(self):
+        """ Strongly connected components (Tarjan, iteratively), in reverse topological order """
+        index = {}
+        lowlink = {}
+        onStack = set()
+        stack = []
+        result = []
+        counter = [ 0 ]
+
+        for start in sorted(self.nodes):
+            if start in index:
+                continue
+            work = [ ( start, iter(sorted(self.edges.get(start, ()))) ) ]
+            index[start] = lowlink[start] = counter[0]
+            counter[0] += 1
+            stack.append(start)
+            onStack.add(start)
+
+            while len(work) > 0:
+                node, children = work[-1]
+                advanced = False
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = counter[0]
+                        counter[0] += 1
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append(( child, iter(sorted(self.edges.get(child, ()))) ))
+                        advanced = True
+                        break
+                    elif child in onStack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                if advanced:
+                    continue
+
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    result.append(component)
+        return result
+
+    def reachableSinks(self, entryPatterns, sinkPatterns):
+        """ { entry node id : [ sink call sites reachable from it ] } for every node matching an entry pattern """
+        def isSink(forms):
+            for form in forms:
+                for pattern in sinkPatterns:
+                    if fnmatch.fnmatchcase(form, pattern):
+                        return True
+            return False
+
+        componentOf = {}
+        reachable = []
+        for number, component in enumerate(self.components()):
+            found = set()
+            for node in component:
+                componentOf[node] = number
+                for forms, description in self.sites.get(node, []):
+                    if isSink(forms):
+                        found.add(description)
+            for node in component:
+                for child in self.edges.get(node, ()):
+                    if componentOf[child] != number:
+                        found.update(reachable[componentOf[child]])
+            reachable.append(frozenset(found))
+
+        result = {}
+        for node in self.nodes:
+            for pattern in entryPatterns:
+                if fnmatch.fnmatchcase(node, pattern):
+                    result[node] = sorted(reachable[componentOf[node]])
+                    break
+        return result
+
+def build(root, workers=1, cache=None):
+    return CallGraph(ast_parser.parseFiles(file_walker.walkFiles([ root ]), workers, cache), root)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+    cache = None
+    cacheDir = ast_parser.popArgument(sys.argv, "--cache")
+    if cacheDir is not None:
+        cache = parse_cache.ParseCache(cacheDir)
+    entries = ast_parser.popArguments(sys.argv, "--entry")
+    sinks = ast_parser.popArguments(sys.argv, "--sink")
+
+    if len(sys.argv) != 2 or len(entries) == 0 or len(sinks) == 0:
+        print "usage: call_graph.py [--jobs N] [--cache DIR] ROOT --entry PATTERN... --sink PATTERN..."
+        sys.exit(1)
+
+    graph = build(sys.argv[1], jobs, cache)
+    print json.dumps(graph.reachableSinks(entries, sinks), indent=4, sort_keys=True)
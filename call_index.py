@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+A persistent, SQLite backed index of call sites, answering "where is db.api.* / session.query called?"
+without walking the classes -> functions -> calls structure of every file.
+
+Every call (and every assignment from a call or attribute) is stored once.  It is then keyed by its dotted
+method path, every prefix of that path, and the same paths with the first name replaced by what the file
+imported it as (db.api.instance_get -> nova.db.api.instance_get when the file did "from nova import db").
+A query is a single index lookup on that key.  An --exact query also has to name the method itself, as written
+or as imported (os.path.join finds path.join after "from os import path").
+
+Building over an existing index replaces it: the new index is built next to it and renamed over it, so files
+deleted since the last build don't linger.
+
+Examples:
+
+./call_index.py build /tmp/nova.db /opt/stack/nova/nova
+./call_index.py query /tmp/nova.db db.api.*
+./call_index.py query /tmp/nova.db session.query
+./call_index.py query /tmp/nova.db --exact self.db.instance_get
+"""
+
+import json
+import os
+import sqlite3
+import sys
+
+import ast_parser
+import file_walker
+import parse_cache
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS sites ( id INTEGER PRIMARY KEY, kind TEXT, method TEXT, filename TEXT, class TEXT, function TEXT, lineno INTEGER, col_offset INTEGER, expanded TEXT )",
+    "CREATE TABLE IF NOT EXISTS keys ( key TEXT, site INTEGER )",
+    "CREATE INDEX IF NOT EXISTS keys_key ON keys ( key )",
+    "CREATE INDEX IF NOT EXISTS keys_site ON keys ( site )",
+    "CREATE INDEX IF NOT EXISTS sites_filename ON sites ( filename )",
+]
+
+# Bump this whenever SCHEMA changes, older indexes have to be rebuilt
+SCHEMA_VERSION = 2
+
+BATCH_SIZE = 10000
+
+COLUMNS = ( "id", "kind", "method", "filename", "class", "function", "lineno", "col_offset" )
+
+def pathComponents(method):
+    """ The method path of a record as a list of names.  Calls within the path (foo().bar) become "foo()".
+
+        >>> pathComponents([ "self", "db", "get" ])
+        ['self', 'db', 'get']
+        >>> pathComponents([ { "method" : "foo" }, "bar" ])
+        ['foo()', 'bar']
+    """
+    components = []
+    for item in method:
+        if isinstance(item, dict):
+            components.append("%s()" % ( item.get("method") or "" ))
+        elif isinstance(item, unicode):
+            components.append(item.encode("utf-8"))
+        else:
+            components.append(str(item))
+    return components
+
+def expandedPath(components, imports):
+    """ The method path with its first name replaced by what the file imported it as, None if it wasn't imported
+
+        >>> expandedPath([ "path", "join" ], { "path" : "os.path" }), expandedPath([ "self", "get" ], {})
+        (['os', 'path', 'join'], None)
+    """
+    if len(components) > 0 and components[0] in imports:
+        return imports[components[0]].split(".") + components[1:]
+    return None
+
+def siteKeys(components, imports):
+    """ Every key a call site is found under.
+
+        >>> sorted(siteKeys([ "db", "api", "get" ], { "db" : "nova.db" }))
+        ['db', 'db.api', 'db.api.get', 'nova', 'nova.db', 'nova.db.api', 'nova.db.api.get']
+    """
+    paths = [ components ]
+    expanded = expandedPath(components, imports)
+    if expanded is not None:
+        paths.append(expanded)
+
+    keys = set()
+    for path in paths:
+        for pos in range(1, len(path) + 1):
+            keys.add(".".join(path[:pos]))
+    return keys
+
+def fileImports(outbound):
+    imports = {}
+    for clz in outbound["imports"]:
+        imports.update(outbound["imports"][clz])
+    return imports
+
+def siteLocation(site):
+    """ ( lineno, col_offset ) of a record.  Attribute assignments inside functions are recorded with their
+        positional fields shifted by one (args holds the line, lineno the column), undo that here.
+
+        >>> siteLocation({ "args" : [], "lineno" : 3, "col_offset" : 4 })
+        (3, 4)
+        >>> siteLocation({ "args" : 3, "lineno" : 4, "col_offset" : [ "foo" ] })
+        (3, 4)
+    """
+    if isinstance(site["col_offset"], int):
+        return site["lineno"], site["col_offset"]
+    return site["args"], site["lineno"]
+
+def iterSites(outbound):
+    """ ( kind, record ) for every record of a file that has a method path """
+    for site in ast_parser.iterCallSites(outbound):
+        if isinstance(site["method"], list) and len(site["method"]) > 0:
+            yield site["kind"], site
+
+class CallIndex(object):
+    """
+        >>> index = CallIndex(":memory:")
+        >>> outbound = ast_parser.handleFile("/abc/api.py", "from nova import db\\ndef get(ctx):\\n    db.api.instance_get(ctx)\\n", {})["/abc/api.py"]
+        >>> index.addFile("/abc/api.py", outbound)
+        >>> index.commit()
+        >>> [ ( site["filename"], site["lineno"], site["method"] ) for site in index.query("nova.db.api.*") ]
+        [('/abc/api.py', 3, 'db.api.instance_get')]
+        >>> len(index.query("db.api.instance_get", exact=True))
+        1
+        >>> len(index.query("db.api.instance", exact=True)), len(index.query("nova.db.api.instance_get", exact=True))
+        (0, 1)
+        >>> index.addFile("/abc/api.py", outbound)
+        >>> index.commit()
+        >>> len(index.query("nova.db.api.*"))
+        1
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        tables = self.connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if tables > 0 and version != SCHEMA_VERSION:
+            raise Exception("%s was built by an older call_index, rebuild it" % path)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.nextId = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM sites").fetchone()[0]
+        self.pendingSites = []
+        self.pendingKeys = []
+
+    def removeFile(self, filename):
+        self.flush()
+        self.connection.execute("DELETE FROM keys WHERE site IN ( SELECT id FROM sites WHERE filename = ? )", ( filename, ))
+        self.connection.execute("DELETE FROM sites WHERE filename = ?", ( filename, ))
+
+    def addFile(self, filename, outbound, replace=True):
+        """ Index the sites of one file, replacing whatever was indexed for it before unless replace is False
+            (filling a new index, where there is nothing to replace)
+        """
+        if replace:
+            self.removeFile(filename)
+        imports = fileImports(outbound)
+        for kind, site in iterSites(outbound):
+            components = pathComponents(site["method"])
+            expanded = expandedPath(components, imports)
+            lineno, col_offset = siteLocation(site)
+            siteId = self.nextId
+            self.nextId += 1
+            self.pendingSites.append((
+                siteId, kind, ".".join(components), filename, site["currentClass"],
+                site["currentFunction"], lineno, col_offset, ".".join(expanded) if expanded is not None else None
+            ))
+            for key in siteKeys(components, imports):
+                self.pendingKeys.append(( key, siteId ))
+
+        if len(self.pendingKeys) > BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany("INSERT INTO sites VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )", self.pendingSites)
+        self.connection.executemany("INSERT INTO keys VALUES ( ?, ? )", self.pendingKeys)
+        self.pendingSites = []
+        self.pendingKeys = []
+
+    def commit(self):
+        self.flush()
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, pattern, exact=False):
+        """ The call sites under pattern (db.api.* and db.api are the same thing), or exactly named pattern
+            (as written, or with the import it starts with expanded)
+        """
+        if pattern.endswith(".*"):
+            pattern = pattern[:-2]
+
+        sql = "SELECT %s FROM keys JOIN sites ON sites.id = keys.site WHERE keys.key = ?" % ", ".join([ "sites.%s" % column for column in COLUMNS ])
+        args = [ pattern ]
+        if exact:
+            sql += " AND ( sites.method = ? OR sites.expanded = ? )"
+            args.extend([ pattern, pattern ])
+        sql += " ORDER BY sites.filename, sites.lineno, sites.col_offset"
+
+        return [ dict(zip(COLUMNS, row)) for row in self.connection.execute(sql, args) ]
+
+def build(indexPath, targets, workers=1, cache=None, exclude=()):
+    """ Index targets into a new index at indexPath, replacing whatever was there
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> indexPath = os.path.join(targetDir, "index.db")
+        >>> for name in ( "a", "b" ):
+        ...     open(os.path.join(targetDir, "%s.py" % name), "w").write("from os import path\\ndef f():\\n    path.join('%s')\\n" % name)
+        >>> [ os.path.basename(site["filename"]) for site in build(indexPath, [ targetDir ]).query("os.path.join", exact=True) ]
+        ['a.py', 'b.py']
+        >>> os.remove(os.path.join(targetDir, "b.py"))
+        >>> [ os.path.basename(site["filename"]) for site in build(indexPath, [ targetDir ]).query("os.path.join", exact=True) ]
+        ['a.py']
+        >>> shutil.rmtree(targetDir)
+    """
+    if indexPath == ":memory:":
+        buildPath = indexPath
+    else:
+        # Built from scratch next to the old index, which is only replaced once the new one is complete
+        buildPath = "%s.tmp" % indexPath
+        if os.path.exists(buildPath):
+            os.remove(buildPath)
+    index = CallIndex(buildPath)
+    for filename, outbound in ast_parser.iterParseFiles(file_walker.walkFiles(targets, exclude=exclude), workers, cache):
+        index.addFile(filename, outbound, replace=False)
+    index.commit()
+    if buildPath == indexPath:
+        return index
+    index.close()
+    os.rename(buildPath, indexPath)
+    return CallIndex(indexPath)
+
+def usage():
+    print "usage: call_index.py build INDEX [--jobs N] [--cache DIR] [--exclude PATTERN]... FILE|DIR..."
+    print "       call_index.py query INDEX [--exact] [--json] PATTERN"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    if len(sys.argv) < 4:
+        usage()
+
+    if sys.argv[1] == "build":
+        jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+        exclude = ast_parser.popArguments(sys.argv, "--exclude")
+        cache = None
+        cacheDir = ast_parser.popArgument(sys.argv, "--cache")
+        if cacheDir is not None:
+            cache = parse_cache.ParseCache(cacheDir)
+        build(sys.argv[2], sys.argv[3:], jobs, cache, exclude)
+
+    elif sys.argv[1] == "query":
+        exact = "--exact" in sys.argv
+        asJson = "--json" in sys.argv
+        args = [ arg for arg in sys.argv if arg not in ( "--exact", "--json" ) ]
+        for site in CallIndex(args[2]).query(args[3], exact):
+            if asJson:
+                print json.dumps(site, sort_keys=True)
+            else:
+                print "%s:%d %s.%s %s" % ( site["filename"], site["lineno"], site["class"], site["function"], site["method"] )
+
+    else:
+        usage()
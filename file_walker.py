@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+Finds the files the tools work on.
+
+Directories are listed by a pool of threads (with scandir when it is installed, which saves a stat per entry,
+os.listdir otherwise), and paths are yielded as soon as they are found so parsing can start before the walk
+is over.  Which files are picked is controlled by gitignore style patterns:
+
+    *.py            a name anywhere in the tree
+    tests/          a directory (and everything below it) anywhere in the tree
+    nova/db/*.py    a path relative to the directory being walked
+    nova/**/api.py  ** matches any number of directories, * and ? never match a /
+    !keep_me.py     un-exclude something an earlier pattern excluded, the last matching pattern wins
+
+Excluded directories are pruned, they are never listed at all.
+
+Examples:
+
+./file_walker.py /opt/stack/nova/nova
+./file_walker.py --exclude tests/ --exclude 'nova/db/sqlalchemy/migrate_repo/' /opt/stack/nova/nova
+./file_walker.py --include '*.py' --include '*.pyw' /opt/stack/nova/nova
+"""
+
+import os
+import Queue
+import re
+import sys
+import threading
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+import ast_parser
+
+DEFAULT_INCLUDE = [ "*.py" ]
+DEFAULT_THREADS = 4
+
+def translatePattern(pattern):
+    """ A regex matching what pattern does: like fnmatch, except that only ** crosses directories
+
+        >>> [ bool(translatePattern("a/*.py").match(path)) for path in ( "a/c.py", "a/b/c.py" ) ]
+        [True, False]
+        >>> [ bool(translatePattern("a/**/c.py").match(path)) for path in ( "a/c.py", "a/b/c.py", "a/b/d/c.py", "ab/c.py" ) ]
+        [True, True, True, False]
+        >>> [ bool(translatePattern("[!a]?.py").match(path)) for path in ( "bc.py", "ac.py", "b/.py" ) ]
+        [True, False, False]
+    """
+    pos, end = 0, len(pattern)
+    parts = []
+    while pos < end:
+        if pattern.startswith("**/", pos):
+            parts.append("(?:.*/)?")
+            pos += 3
+        elif pattern.startswith("**", pos):
+            parts.append(".*")
+            pos += 2
+        elif pattern[pos] == "*":
+            parts.append("[^/]*")
+            pos += 1
+        elif pattern[pos] == "?":
+            parts.append("[^/]")
+            pos += 1
+        elif pattern[pos] == "[":
+            # A character class, taken as is (with ! for negation), like fnmatch.translate does
+            close = pos + 1
+            if close < end and pattern[close] == "!":
+                close += 1
+            if close < end and pattern[close] == "]":
+                close += 1
+            while close < end and pattern[close] != "]":
+                close += 1
+            if close >= end:
+                parts.append("\\[")
+                pos += 1
+                continue
+            chars = pattern[pos + 1:close].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            parts.append("[%s]" % chars)
+            pos = close + 1
+        else:
+            parts.append(re.escape(pattern[pos]))
+            pos += 1
+    return re.compile("".join(parts) + "\\Z")
+
+class IgnoreRules(object):
+    """
+        A list of gitignore style patterns.
+
+        >>> rules = IgnoreRules([ "tests/", "*.pyc", "!keep.pyc", "nova/db/*.py" ])
+        >>> rules.match("nova/tests", True), rules.match("tests.py", False)
+        (True, None)
+        >>> rules.match("a/b/c.pyc", False), rules.match("a/keep.pyc", False)
+        (True, False)
+        >>> rules.match("nova/db/api.py", False), rules.match("other/nova/db/api.py", False)
+        (True, None)
+        >>> rules.match("nova/db/sqlalchemy/api.py", False), IgnoreRules([ "nova/**/api.py" ]).match("nova/db/sqlalchemy/api.py", False)
+        (None, True)
+    """
+    def __init__(self, patterns):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if len(pattern) == 0 or pattern.startswith("#"):
+                continue
+            negated = pattern.startswith("!")
+            if negated:
+                pattern = pattern[1:]
+            directoryOnly = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            # Like git, a pattern with a slash in it is relative to the top, otherwise it matches any name
+            anchored = "/" in pattern
+            self.rules.append(( translatePattern(pattern.lstrip("/")), negated, directoryOnly, anchored ))
+
+    def match(self, relativePath, isDirectory):
+        """ True if the last pattern matching relativePath includes it, False if it negates it, None if none match """
+        name = relativePath.rsplit("/", 1)[-1]
+        matched = None
+        for pattern, negated, directoryOnly, anchored in self.rules:
+            if directoryOnly and not isDirectory:
+                continue
+            if pattern.match(relativePath if anchored else name):
+                matched = not negated
+        return matched
+
+    def excludes(self, relativePath):
+        """ Whether walking would skip relativePath (a file): it, or one of the directories above it, matches
+
+            >>> IgnoreRules([ "tests/" ]).excludes("nova/tests/unit/test_api.py"), IgnoreRules([ "tests/" ]).excludes("nova/api.py")
+            (True, False)
+        """
+        parts = relativePath.split("/")
+        for pos in range(1, len(parts)):
+            if self.match("/".join(parts[:pos]), True):
+                return True
+        return bool(self.match(relativePath, False))
+
+def listEntries(directory):
+    """ ( name, isDirectory ) for everything in directory.  Symlinked directories are not followed, like os.walk. """
+    if scandir is not None:
+        return [ ( entry.name, entry.is_dir(follow_symlinks=False) ) for entry in scandir(directory) ]
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        entries.append(( name, os.path.isdir(path) and not os.path.islink(path) ))
+    return entries
+
+def walkFiles(targets, include=DEFAULT_INCLUDE, exclude=(), threads=DEFAULT_THREADS):
+    """ Yield the files below targets (files or directories) matching include and not exclude, in no
+        particular order, as they are found.  Files named explicitly are always yielded.
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> for path in ( "a.py", "b.txt", "pkg/c.py", "pkg/tests/d.py" ):
+        ...     if not os.path.isdir(os.path.dirname(os.path.join(targetDir, path))):
+        ...         os.makedirs(os.path.dirname(os.path.join(targetDir, path)))
+        ...     open(os.path.join(targetDir, path), "w").write("")
+        >>> sorted([ os.path.relpath(path, targetDir) for path in walkFiles([ targetDir ], exclude=[ "tests/" ]) ])
+        ['a.py', 'pkg/c.py']
+        >>> shutil.rmtree(targetDir)
+    """
+    includeRules = IgnoreRules(include)
+    excludeRules = IgnoreRules(exclude)
+
+    directories = Queue.Queue()
+    found = Queue.Queue()
+    done = object()
+    lock = threading.Lock()
+    pending = [ 0 ]
+    stopped = threading.Event()
+
+    for target in targets:
+        if os.path.isdir(target):
+            pending[0] += 1
+            directories.put(( target, "" ))
+        else:
+            yield target
+    if pending[0] == 0:
+        return
+
+    def finished():
+        with lock:
+            pending[0] -= 1
+            if pending[0] == 0:
+                found.put(done)
+
+    def worker():
+        while True:
+            item = directories.get()
+            if item is None or stopped.is_set():
+                return
+            root, relativeDir = item
+            try:
+                entries = listEntries(os.path.join(root, relativeDir))
+            except OSError:
+                entries = []
+            for name, isDirectory in sorted(entries):
+                relativePath = "%s/%s" % ( relativeDir, name ) if relativeDir else name
+                if excludeRules.match(relativePath, isDirectory):
+                    continue
+                if isDirectory:
+                    with lock:
+                        pending[0] += 1
+                    directories.put(( root, relativePath ))
+                elif includeRules.match(relativePath, False):
+                    found.put(os.path.join(root, relativePath))
+            finished()
+
+    workers = []
+    for pos in range(max(1, threads)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+
+    try:
+        while True:
+            path = found.get()
+            if path is done:
+                break
+            yield path
+    finally:
+        # Also reached when the caller stops early, don't leave the threads walking the rest of the tree
+        stopped.set()
+        for thread in workers:
+            directories.put(None)
+        for thread in workers:
+            thread.join()
+
+def listFiles(targets, include=DEFAULT_INCLUDE, exclude=(), threads=DEFAULT_THREADS):
+    """ Every file walkFiles finds, sorted """
+    return sorted(walkFiles(targets, include, exclude, threads))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    include = ast_parser.popArguments(sys.argv, "--include") or DEFAULT_INCLUDE
+    exclude = ast_parser.popArguments(sys.argv, "--exclude")
+    threads = int(ast_parser.popArgument(sys.argv, "--threads", str(DEFAULT_THREADS)))
+
+    if len(sys.argv) < 2:
+        print "usage: file_walker.py [--include PATTERN]... [--exclude PATTERN]... [--threads N] FILE|DIR..."
+        sys.exit(1)
+
+    for path in walkFiles(sys.argv[1:], include, exclude, threads):
+        print path
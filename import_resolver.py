@@ -3,10 +3,17 @@
 """
 This program is responsible for iterating over all the files and subdirectories of TARGET_DIR, and figuring out all the locations on disk of each import made in that file.
 Additionally, if that file is an "__init__", and there happens to be an "API" function.  We will instantiate that function, and figure out what class was loaded on the init's behalf (of the configuration).
+
+By default modules are located statically, by looking for them below sys.path (and any --root given), nothing gets imported.
+--dynamic falls back to the old pkgutil/__import__ based lookup.
+
+--crawl starts from FILE (or every file below DIR), and keeps going through every local module that gets
+resolved, producing one merged report.
+
+usage: ./import_resolver.py [--cache DIR] [--root DIR]... [--exclude PATTERN]... [--dynamic] [--crawl] FILE|DIR
 """
 
 import copy
-import fnmatch
 import imp
 import inspect
 import json
@@ -23,6 +30,8 @@ bindir = os.path.abspath(os.path.dirname(__file__))
 sys.path.append("%s/../lib" % bindir)
 
 import ast_parser
+import file_walker
+import parse_cache
 
 def getFilenameByImport(modulepath, filename):
     try:
@@ -55,17 +64,180 @@ def figureOutFilenameForModule(modulePath, filename):
 
     return None
 
-def main():
+class ModuleTrieNode(object):
+    """ One dotted name component.  The children are filled in from a single listdir of each directory
+        the component lives in, the first time they are needed. """
+    __slots__ = ( "dirs", "modules", "inits", "children" )
+
+    def __init__(self):
+        self.dirs = []     # ( rootOrder, directory )
+        self.modules = []  # ( rootOrder, suffixOrder, filename ) for name.py, name.so, ...
+        self.inits = []    # ( rootOrder, suffixOrder, filename ) for name/__init__.py, ...
+        self.children = None
+
+class ModuleTrie(object):
+    """
+        A trie of module names over all the search roots.  Every directory is listed at most once per run,
+        after that lookups are dictionary walks along the dotted path.
+
+        >>> trie = ModuleTrie([ bindir ], [ ".py" ])
+        >>> trie.longestPrefix("ast_parser.FuncLister.visit") == os.path.join(bindir, "ast_parser.py")
+        True
+    """
+    def __init__(self, roots, suffixes):
+        self.suffixes = suffixes
+        self.root = ModuleTrieNode()
+        self.root.dirs = [ ( order, root ) for order, root in enumerate(roots) ]
+
+    def children(self, node):
+        if node.children is not None:
+            return node.children
+
+        node.children = {}
+        for order, directory in node.dirs:
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                continue # not a directory after all (a README, a data file, ...)
+
+            for entry in entries:
+                if "." not in entry:
+                    node.children.setdefault(entry, ModuleTrieNode()).dirs.append(( order, os.path.join(directory, entry) ))
+                    continue
+                for suffixOrder, suffix in enumerate(self.suffixes):
+                    if entry.endswith(suffix):
+                        name = entry[:-len(suffix)]
+                        path = os.path.join(directory, entry)
+                        if name == "__init__":
+                            node.inits.append(( order, suffixOrder, path ))
+                        else:
+                            node.children.setdefault(name, ModuleTrieNode()).modules.append(( order, suffixOrder, path ))
+        return node.children
+
+    def filename(self, node):
+        """ The file a node imports as: the first root wins, a package beats a module in the same directory """
+        self.children(node) # finds the __init__ files
+        candidates = [ ( order, 0, suffixOrder, path ) for order, suffixOrder, path in node.inits ]
+        candidates.extend([ ( order, 1, suffixOrder, path ) for order, suffixOrder, path in node.modules ])
+        if len(candidates) == 0:
+            return None
+        return min(candidates)[3]
+
+    def longestPrefix(self, modulePath):
+        """ The file of the longest importable prefix of modulePath, or None """
+        node = self.root
+        found = None
+        for name in modulePath.split("."):
+            node = self.children(node).get(name)
+            if node is None:
+                break
+            filename = self.filename(node)
+            if filename is not None:
+                found = filename
+        return found
+
+class StaticResolver(object):
+    """
+        Maps dotted module paths to files by looking at the filesystem below the search roots, the same way
+        the import machinery would, but without importing (executing) anything.
+
+        Packages, namespace packages (a package spread over several roots) and attributes of modules
+        (from os.path import join -> the module holding join) are handled.  Lookups go through a ModuleTrie
+        shared by every import resolved during the run.
+
+        >>> resolver = StaticResolver(searchPath=[ bindir ])
+        >>> resolver.findModule("ast_parser") == os.path.join(bindir, "ast_parser.py")
+        True
+        >>> resolver.resolve("ast_parser.FuncLister")["filepath"] == os.path.join(bindir, "ast_parser.py")
+        True
+        >>> resolver.resolve("no_such_module.thing") is None
+        True
+    """
+    def __init__(self, extraRoots=None, searchPath=None):
+        if searchPath is None:
+            searchPath = sys.path
+
+        self.roots = []
+        for root in list(extraRoots or []) + list(searchPath):
+            root = os.path.abspath(root or os.curdir)
+            if root not in self.roots and os.path.isdir(root):
+                self.roots.append(root)
+
+        # Same preference order as the import system: extension modules, then source, then bytecode
+        suffixes = [ suffix for suffix, mode, kind in imp.get_suffixes() ]
+        self.trie = ModuleTrie(self.roots, suffixes)
+        self.memo = {}
+
+    def findModule(self, modulePath):
+        """ The file for modulePath, or for the closest module above it when the rest are attributes of that module """
+        return self.trie.longestPrefix(modulePath)
+
+    def resolve(self, modulePath, filename=None):
+        """ Same contract as figureOutFilenameForModule: { "filepath" : ... } or None """
+        if modulePath not in self.memo:
+            found = self.findModule(modulePath)
+            if found is not None:
+                self.memo[modulePath] = { "filepath" : found }
+            elif modulePath.split(".")[0] in sys.builtin_module_names:
+                # Compiled into the interpreter, there is no file (the loader says the same)
+                self.memo[modulePath] = { "filepath" : None }
+            else:
+                self.memo[modulePath] = None
+        return self.memo[modulePath]
+
+def isUnder(filepath, directory):
+    """
+        >>> isUnder("/opt/stack/nova/nova/db/api.py", "/opt/stack/nova")
+        True
+        >>> isUnder("/opt/stack/novaclient/api.py", "/opt/stack/nova")
+        False
+    """
+    directory = os.path.join(os.path.abspath(directory), "")
+    return os.path.abspath(filepath).startswith(directory)
+
+def packageRoot(directory):
+    """ The directory package-absolute imports of modules in directory are resolved from: the parent of the
+        topmost package above it, or directory itself when it isn't a package
+
+        >>> import shutil, tempfile
+        >>> top = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(top, "app", "sub"))
+        >>> for package in ( "app", "app/sub" ):
+        ...     open(os.path.join(top, package, "__init__.py"), "w").write("")
+        >>> packageRoot(os.path.join(top, "app", "sub")) == top
+        True
+        >>> packageRoot(top) == top
+        True
+        >>> shutil.rmtree(top)
+    """
+    directory = os.path.abspath(directory)
+    while os.path.exists(os.path.join(directory, "__init__.py")):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return directory
+
+def resolveImports(filesToProcess, resolve, cache=None, crawlRoot=None):
+    ''' Resolve every import of every file in filesToProcess.  Each module path is resolved once per run, the
+        result (a filepath, not found, or an error) is remembered in a memo table shared by all files.
+
+        With a crawlRoot, each resolved module that lives below crawlRoot is added to filesToProcess, so the
+        whole local tree reachable from the starting files gets processed, and the memo table is reported
+        under "modules".
+    '''
     couldNotFind = {}
     errors = {}
     success = {}
-    filesToProcess = []
+    memo = {}
+    failed = set()
 
-    targetFile = sys.argv[1]
-    filesToProcess.append(targetFile)
+    # Absolute, like the paths of crawled modules, so the report is keyed consistently
+    filesToProcess = [ os.path.abspath(fname) for fname in filesToProcess ]
+    seen = set(filesToProcess)
 
     for fname in filesToProcess:
-        parsed = ast_parser.parseFile(fname)
+        parsed = ast_parser.parseFile(fname, cache, profile="imports")
 
         # Iterate over each filename in the response from the ast parser
         for filename in parsed.keys():
@@ -74,13 +246,17 @@ def main():
             # Iterate over each class imported by the current file
             for clz in parsed[filename]['imports'].keys():
                 for asName, modulePath in parsed[filename]['imports'][clz].iteritems():
-                    res = None
-                    try:
-                        res = figureOutFilenameForModule(modulePath, filename)
-                        #print "filename=%s, res=%s" % ( filename, res )
-                    except Exception as ex:
-                        print "modulePath=%s, filename=%s" % ( str(modulePath), filename )
-                        traceback.print_exc()
+                    if modulePath not in memo:
+                        memo[modulePath] = None
+                        try:
+                            memo[modulePath] = resolve(modulePath, filename)
+                        except Exception as ex:
+                            print "modulePath=%s, filename=%s" % ( str(modulePath), filename )
+                            traceback.print_exc()
+                            failed.add(modulePath)
+
+                    res = memo[modulePath]
+                    if modulePath in failed:
                         if filename not in errors.keys():
                             errors[filename] = []
                         errors[filename].append(modulePath)
@@ -91,9 +267,68 @@ def main():
                         if filename not in couldNotFind.keys():
                             couldNotFind[filename] = []
                         couldNotFind[filename].append(modulePath)
+                        continue
+
+                    filepath = res["filepath"]
+                    if crawlRoot is not None and filepath is not None and filepath.endswith(".py") and isUnder(filepath, crawlRoot):
+                        if os.path.abspath(filepath) not in seen:
+                            seen.add(os.path.abspath(filepath))
+                            filesToProcess.append(filepath)
 
     myOutbound = { "couldNotFind" : couldNotFind, "errors" : errors, "success" : success }
+    if crawlRoot is not None:
+        modules = {}
+        for modulePath, res in memo.iteritems():
+            if modulePath in failed:
+                modules[modulePath] = "error"
+            elif res is None:
+                modules[modulePath] = "notFound"
+            else:
+                modules[modulePath] = res["filepath"]
+        myOutbound["modules"] = modules
+    return myOutbound
+
+def main():
+    resolve = None
+    if "--dynamic" in sys.argv:
+        sys.argv.remove("--dynamic")
+        resolve = figureOutFilenameForModule
+
+    crawl = "--crawl" in sys.argv
+    if crawl:
+        sys.argv.remove("--crawl")
+
+    extraRoots = ast_parser.popArguments(sys.argv, "--root")
+    exclude = ast_parser.popArguments(sys.argv, "--exclude")
+
+    cache = None
+    cacheDir = ast_parser.popArgument(sys.argv, "--cache")
+    if cacheDir is not None:
+        cache = parse_cache.ParseCache(cacheDir)
+
+    target = sys.argv[1]
+    filesToProcess = [ target ]
+    crawlRoot = None
+    if crawl:
+        if os.path.isdir(target):
+            crawlRoot = target
+            filesToProcess = file_walker.listFiles([ target ], exclude=exclude)
+            extraRoots.append(packageRoot(target))
+        else:
+            # The file's package (and whatever sits next to it) is what gets crawled
+            crawlRoot = packageRoot(os.path.dirname(os.path.abspath(target)))
+            extraRoots.append(crawlRoot)
+
+    if resolve is None:
+        resolve = StaticResolver(extraRoots).resolve
+
+    myOutbound = resolveImports(filesToProcess, resolve, cache, crawlRoot)
     print json.dumps(myOutbound, indent=4, sort_keys=True)
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
     main()
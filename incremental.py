@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+"""
+Incremental re-analysis of a tree.
+
+A snapshot holds the ast_parser outbound structure of every file of a tree (plus the mtime and size each one
+was parsed at), the inherits_from hierarchy of the tree and, optionally, the inherits_from result for a set of
+base classes.  Updating a snapshot only re-parses the files that changed, drops the files that were deleted,
+patches the hierarchy with the edges of those files, and recomputes the inherits_from result from it, which
+needs no parsing at all.
+
+A snapshot is a directory: a small manifest (stamps, hierarchy, settings) and one pickle per file, so an update
+only reads the manifest and writes the manifest and the files that changed.
+
+The changed files come from the command line (relative to the tree), from "git diff --name-only", or from
+comparing mtimes.  Either way only the .py files of the tree that the exclude patterns let through are taken.
+
+Examples:
+
+./incremental.py build /tmp/neutron.snapshot /opt/stack/neutron/neutron model_base.BASEV2
+./incremental.py update /tmp/neutron.snapshot --git HEAD~1
+./incremental.py update /tmp/neutron.snapshot db/models_v2.py
+./incremental.py watch /tmp/neutron.snapshot --interval 2
+"""
+
+import cPickle
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from UserDict import DictMixin
+
+import ast_parser
+import file_walker
+import inherits_from
+
+MANIFEST_NAME = "manifest.pickle"
+FILES_DIR = "files"
+
+class SnapshotFiles(DictMixin):
+    """
+        The filename -> outbound mapping of a snapshot, one pickle per file below the snapshot directory.
+        Entries are loaded when they are first asked for, and only the ones set or deleted since the last save
+        are written back.
+
+        >>> import shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> files = SnapshotFiles()
+        >>> files["/a.py"] = { "classes" : {}, "imports" : {} }
+        >>> files["/b.py"] = { "classes" : {}, "imports" : { "b" : {} } }
+        >>> files.writeEntries(directory)
+        >>> loaded = SnapshotFiles(directory, [ "/a.py", "/b.py" ])
+        >>> loaded["/b.py"], len(loaded.loaded)
+        ({'imports': {'b': {}}, 'classes': {}}, 1)
+        >>> del loaded["/a.py"]
+        >>> loaded.writeEntries(directory); loaded.removeEntries()
+        >>> sorted(loaded.keys()), os.path.exists(loaded.entryPath("/a.py"))
+        (['/b.py'], False)
+        >>> shutil.rmtree(directory)
+    """
+    def __init__(self, directory=None, names=()):
+        self.directory = directory
+        self.names = set(names)
+        self.loaded = {}
+        self.dirty = set()
+        self.removed = set()
+
+    def entryPath(self, filename, directory=None):
+        digest = hashlib.sha1(filename).hexdigest()
+        return os.path.join(directory or self.directory, FILES_DIR, digest[:2], "%s.pickle" % digest)
+
+    def __getitem__(self, filename):
+        if filename not in self.names:
+            raise KeyError(filename)
+        if filename not in self.loaded:
+            with open(self.entryPath(filename), "rb") as fh:
+                self.loaded[filename] = cPickle.load(fh)
+        return self.loaded[filename]
+
+    def __setitem__(self, filename, outbound):
+        self.names.add(filename)
+        self.loaded[filename] = outbound
+        self.dirty.add(filename)
+        self.removed.discard(filename)
+
+    def __delitem__(self, filename):
+        if filename not in self.names:
+            raise KeyError(filename)
+        self.names.remove(filename)
+        self.loaded.pop(filename, None)
+        self.dirty.discard(filename)
+        self.removed.add(filename)
+
+    def keys(self):
+        return list(self.names)
+
+    def __contains__(self, filename):
+        return filename in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def writeEntries(self, directory):
+        """ Write what changed to directory, or everything when it isn't where the entries came from """
+        if directory == self.directory:
+            toWrite = self.dirty
+        else:
+            toWrite = self.names
+            self.removed = set()
+        for filename in toWrite:
+            entryPath = self.entryPath(filename, directory)
+            if not os.path.isdir(os.path.dirname(entryPath)):
+                os.makedirs(os.path.dirname(entryPath))
+            fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(entryPath), suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                cPickle.dump(self[filename], fh, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpPath, entryPath)
+        self.directory = directory
+        self.dirty = set()
+
+    def removeEntries(self):
+        """ Delete the entries of the files deleted since the last save, once the manifest no longer lists them """
+        for filename in self.removed:
+            try:
+                os.remove(self.entryPath(filename))
+            except OSError:
+                pass
+        self.removed = set()
+
+def findFiles(targetDir, exclude=inherits_from.DEFAULT_EXCLUDE):
+    """ Every .py file below targetDir, as absolute paths, skipping what inherits_from skips """
+    return inherits_from.findPythonFiles(os.path.abspath(targetDir), exclude)
+
+def treeFiles(targetDir, filenames, exclude=inherits_from.DEFAULT_EXCLUDE):
+    """ The absolute paths of those filenames (relative ones being relative to targetDir) that are .py files of
+        the tree the exclude patterns let through
+
+        >>> treeFiles("/src/nova", [ "api.py", "/src/nova/db/api.py", "README", "tests/test_api.py", "/other/x.py" ])
+        ['/src/nova/api.py', '/src/nova/db/api.py']
+    """
+    targetDir = os.path.abspath(targetDir)
+    rules = file_walker.IgnoreRules(exclude)
+    selected = []
+    for filename in filenames:
+        filename = os.path.abspath(os.path.join(targetDir, filename))
+        relativePath = os.path.relpath(filename, targetDir)
+        if filename.endswith(".py") and not relativePath.startswith("..") and not rules.excludes(relativePath):
+            selected.append(filename)
+    return selected
+
+def fileStamp(filename):
+    st = os.stat(filename)
+    return ( st.st_mtime, st.st_size )
+
+def parseStamped(filename, cache=None):
+    """ ( filename, stamp, outbound, error ) for one file, the stamp taken before it is read.  A file that can't
+        be parsed comes back with its error (and no outbound) instead of raising.
+    """
+    stamp = None
+    try:
+        stamp = fileStamp(filename)
+        filename, outbound = ast_parser.parseOne(filename, cache)
+        return filename, stamp, outbound, None
+    except Exception as ex:
+        return filename, stamp, None, "%s: %s" % ( type(ex).__name__, ex )
+
+def iterParseStamped(files, workers=1, cache=None):
+    """ parseStamped for each of files, in a pool of workers processes when there is more than one """
+    if workers <= 1 or len(files) <= 1:
+        for filename in files:
+            yield parseStamped(filename, cache)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for item in pool.imap_unordered(functools.partial(parseStamped, cache=cache), files, max(1, len(files) / (workers * 4))):
+            yield item
+    finally:
+        pool.close()
+        pool.join()
+        if cache is not None:
+            cache.checkSize()
+
+def buildSnapshot(targetDir, toCheck=None, cache=None, workers=1, exclude=inherits_from.DEFAULT_EXCLUDE):
+    """ Parse the whole of targetDir into a new snapshot.  Files that don't parse are left out, and listed under
+        "failed" (with their stamp) so they are picked up once they change.
+    """
+    snapshot = {
+        "version" : ast_parser.PARSER_VERSION,
+        "targetDir" : os.path.abspath(targetDir),
+        "exclude" : list(exclude),
+        "files" : SnapshotFiles(),
+        "stamps" : {},
+        "failed" : {},
+        "hierarchy" : {},
+        "toCheck" : list(toCheck or []),
+        "inheritsFrom" : {}
+    }
+    for filename, stamp, outbound, error in iterParseStamped(findFiles(targetDir, exclude), workers, cache):
+        if error is not None:
+            sys.stderr.write("%s: %s\n" % ( filename, error ))
+            snapshot["failed"][filename] = stamp
+            continue
+        snapshot["files"][filename] = outbound
+        snapshot["stamps"][filename] = stamp
+    snapshot["hierarchy"] = inherits_from.buildHierarchy(snapshot["files"])
+    updateInherits(snapshot)
+    return snapshot
+
+def loadSnapshot(path):
+    """ The snapshot saved in the directory path, only its manifest is read (see SnapshotFiles) """
+    manifestPath = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(manifestPath):
+        raise Exception("%s is not a snapshot (or predates per-file snapshots), rebuild it" % path)
+    with open(manifestPath, "rb") as fh:
+        snapshot = cPickle.load(fh)
+    if snapshot.get("version") != ast_parser.PARSER_VERSION:
+        raise Exception("snapshot %s was built by parser version %s, rebuild it" % ( path, snapshot.get("version") ))
+    snapshot["files"] = SnapshotFiles(path, snapshot["files"])
+    return snapshot
+
+def saveSnapshot(path, snapshot):
+    """ Write the files that changed since the snapshot was loaded (all of them for a new one), then the manifest """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    elif len(os.listdir(path)) > 0 and not os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        raise Exception("%s is not empty and not a snapshot, refusing to write to it" % path)
+
+    files = snapshot["files"]
+    files.writeEntries(path)
+    manifest = dict(snapshot)
+    manifest["files"] = sorted(files.keys())
+    tmpPath = os.path.join(path, "%s.tmp" % MANIFEST_NAME)
+    with open(tmpPath, "wb") as fh:
+        cPickle.dump(manifest, fh, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmpPath, os.path.join(path, MANIFEST_NAME))
+    files.removeEntries()
+
+def patchHierarchy(hierarchy, removed, added):
+    """ Drop the edges of the removed files from an inherits_from hierarchy and add those of added, a
+        { filename : outbound } of new or re-parsed files.
+
+        >>> hierarchy = { "Base" : [ ( "Foo", "a.py" ), ( "Bar", "b.py" ) ] }
+        >>> patchHierarchy(hierarchy, [ "a.py" ], { "a.py" : { "classes" : { "Baz" : { "inheritsFrom" : [ [ "Base" ] ] } } } })
+        {'Base': [('Bar', 'b.py'), ('Baz', 'a.py')]}
+    """
+    removed = set(removed) | set(added.keys())
+    for baseName, edges in hierarchy.items():
+        edges[:] = [ ( clz, filename ) for clz, filename in edges if filename not in removed ]
+        if len(edges) == 0:
+            del hierarchy[baseName]
+    for baseName, edges in inherits_from.buildHierarchy(added).iteritems():
+        hierarchy.setdefault(baseName, []).extend(edges)
+        hierarchy[baseName].sort()
+    return hierarchy
+
+def updateInherits(snapshot):
+    """ Recompute the inherits_from result of the snapshot, from its hierarchy """
+    if len(snapshot["toCheck"]) > 0:
+        snapshot["inheritsFrom"] = inherits_from.findSubclasses(snapshot["hierarchy"], snapshot["toCheck"])
+    return snapshot["inheritsFrom"]
+
+def gitChangedFiles(targetDir, since="HEAD", exclude=inherits_from.DEFAULT_EXCLUDE):
+    """ The .py files below targetDir that differ from the since revision, or are new and untracked """
+    topLevel = subprocess.check_output([ "git", "rev-parse", "--show-toplevel" ], cwd=targetDir).strip()
+    names = subprocess.check_output([ "git", "diff", "--name-only", since, "--", "." ], cwd=targetDir).splitlines()
+    names.extend(subprocess.check_output(
+        [ "git", "ls-files", "--others", "--exclude-standard", "--full-name", "--", "." ], cwd=targetDir
+    ).splitlines())
+    return treeFiles(targetDir, [ os.path.join(topLevel, name) for name in names ], exclude)
+
+def polledChangedFiles(snapshot):
+    """ The files whose mtime or size moved since they were parsed, the new ones and the deleted ones.
+        A file that failed to parse is only picked up again once it changes again.
+    """
+    failed = snapshot.get("failed", {})
+    changed = []
+    for filename in findFiles(snapshot["targetDir"], snapshot.get("exclude", inherits_from.DEFAULT_EXCLUDE)):
+        try:
+            stamp = fileStamp(filename)
+            if snapshot["stamps"].get(filename) != stamp and failed.get(filename) != stamp:
+                changed.append(filename)
+        except OSError:
+            pass # deleted while we were looking, picked up below
+
+    for filename in snapshot["files"].keys() + failed.keys():
+        if not os.path.exists(filename):
+            changed.append(filename)
+    return changed
+
+def applyChanges(snapshot, changedFiles):
+    """ Re-parse the changed files, drop the deleted ones, and recompute the inherits_from result.
+
+        Relative paths are relative to the tree, and paths that aren't .py files of the tree (or that the
+        snapshot's exclude patterns leave out) are skipped, and reported under "ignored".
+
+        Every file is parsed before the snapshot is touched.  A file that can't be parsed (someone is half
+        way through editing it) keeps its previous structure and is reported under "failed" with its error,
+        everything else is applied.
+
+        >>> import shutil
+        >>> targetDir = tempfile.mkdtemp()
+        >>> open(os.path.join(targetDir, "a.py"), "w").write("class Foo(Base):\\n    pass\\n")
+        >>> snapshot = buildSnapshot(targetDir, [ "Base" ])
+        >>> snapshot["inheritsFrom"].keys()
+        ['Foo']
+        >>> open(os.path.join(targetDir, "b.py"), "w").write("class Bar(Foo):\\n    pass\\n")
+        >>> os.remove(os.path.join(targetDir, "a.py"))
+        >>> summary = applyChanges(snapshot, [ os.path.join(targetDir, "a.py"), "b.py", "README", "tests/test_b.py" ])
+        >>> [ os.path.basename(filename) for filename in summary["deleted"] ], [ os.path.basename(filename) for filename in summary["updated"] ], summary["ignored"]
+        (['a.py'], ['b.py'], ['README', 'tests/test_b.py'])
+        >>> snapshot["inheritsFrom"]
+        {}
+        >>> open(os.path.join(targetDir, "b.py"), "w").write("class Bar(Foo:\\n")
+        >>> open(os.path.join(targetDir, "c.py"), "w").write("class Baz(Base):\\n    pass\\n")
+        >>> summary = applyChanges(snapshot, [ os.path.join(targetDir, "b.py"), os.path.join(targetDir, "c.py") ])
+        >>> [ os.path.basename(filename) for filename in summary["updated"] ], [ os.path.basename(filename) for filename in summary["failed"] ]
+        (['c.py'], ['b.py'])
+        >>> sorted(snapshot["inheritsFrom"].keys()), polledChangedFiles(snapshot)
+        (['Baz'], [])
+        >>> saveSnapshot(os.path.join(targetDir, "snapshot"), snapshot)
+        >>> loaded = loadSnapshot(os.path.join(targetDir, "snapshot"))
+        >>> sorted(loaded["files"].keys()) == sorted(snapshot["files"].keys()), loaded["hierarchy"] == snapshot["hierarchy"]
+        (True, True)
+        >>> shutil.rmtree(targetDir)
+    """
+    snapshot.setdefault("failed", {})
+    exclude = snapshot.get("exclude", inherits_from.DEFAULT_EXCLUDE)
+    selected = treeFiles(snapshot["targetDir"], changedFiles, exclude)
+    ignored = [ filename for filename in changedFiles if os.path.abspath(os.path.join(snapshot["targetDir"], filename)) not in selected ]
+
+    deleted = []
+    toParse = []
+    for filename in selected:
+        if os.path.exists(filename):
+            toParse.append(filename)
+        elif filename in snapshot["files"] or filename in snapshot["failed"]:
+            deleted.append(filename)
+
+    parsed = {}
+    failed = {}
+    for filename, stamp, outbound, error in iterParseStamped(toParse):
+        if error is None:
+            parsed[filename] = ( stamp, outbound )
+        else:
+            failed[filename] = ( stamp, error )
+
+    # Nothing has been changed up to here
+    for filename in deleted:
+        if filename in snapshot["files"]:
+            del snapshot["files"][filename]
+        snapshot["stamps"].pop(filename, None)
+        snapshot["failed"].pop(filename, None)
+    for filename, ( stamp, outbound ) in parsed.iteritems():
+        snapshot["files"][filename] = outbound
+        snapshot["stamps"][filename] = stamp
+        snapshot["failed"].pop(filename, None)
+    for filename, ( stamp, error ) in failed.iteritems():
+        snapshot["failed"][filename] = stamp
+    patchHierarchy(snapshot["hierarchy"], deleted, dict([ ( filename, outbound ) for filename, ( stamp, outbound ) in parsed.iteritems() ]))
+
+    return {
+        "updated" : [ filename for filename in toParse if filename in parsed ],
+        "deleted" : deleted,
+        "failed" : dict([ ( filename, error ) for filename, ( stamp, error ) in failed.iteritems() ]),
+        "ignored" : ignored,
+        "inheritsFrom" : updateInherits(snapshot)
+    }
+
+def watch(snapshotPath, interval):
+    """ Keep the snapshot up to date by polling mtimes, saving and reporting after every change """
+    snapshot = loadSnapshot(snapshotPath)
+    while True:
+        try:
+            changed = polledChangedFiles(snapshot)
+            if len(changed) > 0:
+                summary = applyChanges(snapshot, changed)
+                saveSnapshot(snapshotPath, snapshot)
+                print json.dumps(summary, indent=4, sort_keys=True)
+                sys.stdout.flush()
+        except Exception:
+            # Files come and go while they are being edited, try again next time round
+            traceback.print_exc()
+        time.sleep(interval)
+
+def usage():
+    print "usage: incremental.py build SNAPSHOT [--jobs N] [--exclude PATTERN]... DIR [CLASS...]"
+    print "       incremental.py update SNAPSHOT [--git REV | FILE...]"
+    print "       incremental.py watch SNAPSHOT [--interval SECONDS]"
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    if len(sys.argv) < 3:
+        usage()
+
+    command = sys.argv[1]
+    snapshotPath = sys.argv[2]
+
+    if command == "build" and len(sys.argv) >= 4:
+        jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+        exclude = ast_parser.popArguments(sys.argv, "--exclude") or inherits_from.DEFAULT_EXCLUDE
+        snapshot = buildSnapshot(sys.argv[3], sys.argv[4:], workers=jobs, exclude=exclude)
+        saveSnapshot(snapshotPath, snapshot)
+        print json.dumps(snapshot["inheritsFrom"], indent=4, sort_keys=True)
+
+    elif command == "update":
+        since = ast_parser.popArgument(sys.argv, "--git")
+        snapshot = loadSnapshot(snapshotPath)
+        if since is not None:
+            changed = gitChangedFiles(snapshot["targetDir"], since, snapshot.get("exclude", inherits_from.DEFAULT_EXCLUDE))
+        elif len(sys.argv) > 3:
+            changed = sys.argv[3:]
+        else:
+            changed = polledChangedFiles(snapshot)
+
+        summary = applyChanges(snapshot, changed)
+        saveSnapshot(snapshotPath, snapshot)
+        print json.dumps(summary, indent=4, sort_keys=True)
+
+    elif command == "watch":
+        watch(snapshotPath, float(ast_parser.popArgument(sys.argv, "--interval", "2")))
+
+    else:
+        usage()
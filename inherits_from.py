@@ -10,75 +10,170 @@ Find all the classes that inherit from model_base.BASEV2 in the neutron director
 ./inherits_from.py /opt/stack/neutron/neutron model_base.BASEV2
 
 ./inherits_from.py /opt/stack/cinder/cinder rpc.RPCAPI
+
+Re-use parse results between runs by pointing at a cache directory:
+
+./inherits_from.py --cache /tmp/ast_cache /opt/stack/cinder/cinder rpc.RPCAPI
+
+Tests are skipped unless other gitignore style --exclude patterns are given (see file_walker):
+
+./inherits_from.py --exclude 'cinder/tests/unit/' /opt/stack/cinder/cinder rpc.RPCAPI
 """
 
-import fnmatch
 import json
+import mmap
 import os
+import re
 import sys
 
 from pprint import pprint
 
 import ast_parser
-
-def merge_two_dicts(x, y):
-    '''Given two dicts, merge them into a new dict as a shallow copy.'''
-    z = x.copy()
-    z.update(y)
-    return z
-
-def traverseMatches(matches, filesFound, toCheck):
-    ''' Iterate over the file/directory matches, and see if they inherit from our toCheck list '''
-    outbound = {}
-    for mtch in matches:
-        if "/tests/" in mtch:
-            continue
-
-        res = ast_parser.parseFile(mtch)
-        for filename in res.keys():
-            for clz in res[filename]['classes']:
-                inheritsFrom = res[filename]['classes'][clz]['inheritsFrom']
-                if len(inheritsFrom) > 0:
-                    for val in inheritsFrom:
-                        baseName = ".".join(val)
-                        if baseName in toCheck:
-                            #print "filename=%s, class=%s, inheritsFrom=%s" % ( filename, clz, str(inheritsFrom) )
-                            outbound[clz] = filename
-                            filesFound.append(filename)
-    return outbound
-
-def handle(targetDir, toCheck):
-    ''' Walk the targetDir, and call traverseMatches until everything that inherits from toCheck, or from the modules that inherit from toCheck are resolved '''
-    matches = []
-    filesFound = []
+import file_walker
+import parse_cache
+
+DEFAULT_EXCLUDE = [ "tests/" ]
+
+def findPythonFiles(targetDir, exclude=DEFAULT_EXCLUDE):
+    ''' Every .py file below targetDir, except for tests (or whatever exclude patterns are given) '''
+    return file_walker.listFiles([ targetDir ], exclude=exclude)
+
+def buildHierarchy(parsed):
+    ''' Given the output of ast_parser.parseFiles, build a map of base class name -> [ ( subclass, filename ) ]
+
+        >>> parsed = { "a.py" : { "classes" : {
+        ...     "a" : { "inheritsFrom" : [] },
+        ...     "Foo" : { "inheritsFrom" : [ [ "model_base", "BASEV2" ], [ "object" ] ] } } } }
+        >>> graph = buildHierarchy(parsed)
+        >>> graph["model_base.BASEV2"]
+        [('Foo', 'a.py')]
+        >>> graph["object"]
+        [('Foo', 'a.py')]
+    '''
+    graph = {}
+    for filename in parsed.keys():
+        for clz in parsed[filename]['classes']:
+            for val in parsed[filename]['classes'][clz]['inheritsFrom']:
+                baseName = ".".join(val)
+                graph.setdefault(baseName, []).append(( clz, filename ))
+    # Sorted, so the result doesn't depend on the order the files were parsed (or merged, see shard_analysis) in
+    for edges in graph.values():
+        edges.sort()
+    return graph
+
+def findSubclasses(graph, toCheck):
+    ''' Walk the hierarchy graph once, returning { subclass : filename } for everything that inherits
+        (directly or transitively) from a name in toCheck.
+
+        >>> graph = { "Base" : [ ( "Mid", "m.py" ) ], "Mid" : [ ( "Leaf", "l.py" ) ], "Other" : [ ( "X", "x.py" ) ] }
+        >>> sorted(findSubclasses(graph, [ "Base" ]).items())
+        [('Leaf', 'l.py'), ('Mid', 'm.py')]
+    '''
     classesFound = {}
+    seen = set(toCheck)
+    toVisit = list(toCheck)
+    while len(toVisit) > 0:
+        baseName = toVisit.pop()
+        for clz, filename in graph.get(baseName, []):
+            classesFound[clz] = filename
+            if clz not in seen:
+                seen.add(clz)
+                toVisit.append(clz)
+    return classesFound
 
-    for root, dirnames, filenames in os.walk(targetDir):
-        for filename in fnmatch.filter(filenames, '*.py'):
-            matches.append(os.path.join(root, filename))
-
-    prevCount = len(filesFound)
-
-    while True:
-        toCheck      = traverseMatches(matches, filesFound, toCheck)
-        classesFound = merge_two_dicts(classesFound, toCheck)
-        toCheck      = toCheck.keys()
+def baseToken(name):
+    ''' The word a file has to contain to possibly subclass name: the last component of the dotted name
+
+        >>> baseToken("model_base.BASEV2")
+        'BASEV2'
+    '''
+    return name.split(".")[-1]
+
+def tokenPattern(names):
+    ''' One regex matching any of the base tokens of names, as whole words
+
+        >>> pattern = tokenPattern([ "model_base.BASEV2", "Mid" ])
+        >>> [ bool(pattern.search(text)) for text in ( "class A(model_base.BASEV2):", "class A(Middle):", "(Mid)" ) ]
+        [True, False, True]
+    '''
+    tokens = sorted(set([ re.escape(baseToken(name)) for name in names ]), key=len, reverse=True)
+    return re.compile(r"\b(?:%s)\b" % "|".join(tokens))
+
+def fileMentions(filename, pattern):
+    ''' Whether the raw bytes of filename match pattern, scanning a memory map rather than reading the file '''
+    try:
+        with open(filename, "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return False
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return pattern.search(mapped) is not None
+            finally:
+                mapped.close()
+    except (IOError, OSError, ValueError):
+        return True # let the parser report whatever is wrong with it
+
+def handle(targetDir, toCheck, cache=None, workers=1, exclude=DEFAULT_EXCLUDE):
+    ''' Return everything below targetDir that inherits from toCheck, or from the classes that inherit from toCheck.
+
+        A class can only inherit from a name its file mentions, so only the files that mention one of the names
+        looked for are parsed.  Every subclass found becomes a name to look for in the files not parsed yet,
+        until no new names turn up.  Each file is scanned once per round and parsed at most once.
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> open(os.path.join(targetDir, "a.py"), "w").write("class Mid(model_base.BASEV2):\\n    pass\\n")
+        >>> open(os.path.join(targetDir, "b.py"), "w").write("class Leaf(Mid):\\n    pass\\n")
+        >>> open(os.path.join(targetDir, "c.py"), "w").write("class Other(object):\\n    pass\\n")
+        >>> sorted(handle(targetDir, [ "model_base.BASEV2" ]).keys())
+        ['Leaf', 'Mid']
+        >>> shutil.rmtree(targetDir)
+    '''
+    remaining = findPythonFiles(targetDir, exclude)
+    parsed = {}
+    names = list(toCheck)
+    searched = set()
+    classesFound = {}
 
-        if prevCount == len(filesFound):
-            break
-        prevCount = len(filesFound)
+    while len(names) > 0 and len(remaining) > 0:
+        searched.update(names)
+        pattern = tokenPattern(names)
+        candidates = []
+        notMatched = []
+        for filename in remaining:
+            if fileMentions(filename, pattern):
+                candidates.append(filename)
+            else:
+                notMatched.append(filename)
+        remaining = notMatched
+
+        parsed.update(ast_parser.parseFiles(candidates, workers=workers, cache=cache, profile="classes"))
+        classesFound = findSubclasses(buildHierarchy(parsed), toCheck)
+        names = [ clz for clz in classesFound if clz not in searched ]
 
     return classesFound
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+    exclude = ast_parser.popArguments(sys.argv, "--exclude") or DEFAULT_EXCLUDE
+    cache = None
+    cacheDir = ast_parser.popArgument(sys.argv, "--cache")
+    if cacheDir is not None:
+        cache = parse_cache.ParseCache(cacheDir)
+
     if len(sys.argv) < 3:
-        raise Exception("usage: inherits_from.py DIR CLASS...")
+        raise Exception("usage: inherits_from.py [--jobs N] [--cache DIR] [--exclude PATTERN]... DIR CLASS...")
 
     targetDir = sys.argv[1]
     toCheck   = sys.argv[2:]
 
     #print "targetDir = %s, toCheck = %s" % ( targetDir, str(toCheck) )
 
-    result = handle(targetDir, toCheck)
+    result = handle(targetDir, toCheck, cache, jobs, exclude)
     print json.dumps(result, indent=4, sort_keys=True)
     #pprint(result)
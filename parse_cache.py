@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+A persistent, on-disk cache of ast_parser.handleFile results.
+
+Each parsed file gets one pickle in the cache directory.  An entry is keyed by the path of the file and the
+parser version, and remembers the mtime, size and content hash of the file it was built from.  When the
+mtime and size still match the entry is used as is; when they don't, the content is hashed and the entry is
+still used if the bytes did not actually change (a touch, a fresh checkout, etc).
+
+The cache directory is bounded in size, the least recently used entries are evicted first.  Only the process
+that created the cache enforces the bound: the copies pool workers get write entries but leave the size alone,
+checkSize() is called once the pool is done.
+
+usage: ./parse_cache.py clear CACHE_DIR
+       ./parse_cache.py test
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import ast_parser
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+def hashContent(fileContent):
+    """ The content hash stored in each cache entry.
+
+        >>> len(hashContent("a = 1"))
+        40
+    """
+    return hashlib.sha1(fileContent).hexdigest()
+
+class ParseCache(object):
+    """
+        Stores the outbound structure of handleFile for each file, so only changed files get re-parsed.
+
+        >>> cacheDir = tempfile.mkdtemp()
+        >>> sourceDir = tempfile.mkdtemp()
+        >>> source = os.path.join(sourceDir, "foo.py")
+        >>> open(source, "w").write("a = 'abc'")
+        >>> cache = ParseCache(cacheDir)
+        >>> cache.get(source) is None
+        True
+        >>> res = ast_parser.parseFiles([ source ], cache=cache)
+        >>> cache.get(source) == res[source]
+        True
+        >>> cache.get(source, "imports") is None
+        True
+        >>> cache.put(source, "a = 'abc'", res[source]); cache.put(source, "a = 'abc'", res[source])
+        >>> cache.currentBytes == cache.diskUsage()
+        True
+        >>> open(source, "w").write("a = 'abcd'")
+        >>> cache.get(source) is None
+        True
+        >>> st = os.stat(source)
+        >>> open(source, "w").write("a = 'abcde'")
+        >>> cache.put(source, "a = 'abcd'", res[source], st=st)
+        >>> cache.get(source) is None
+        True
+        >>> worker = cPickle.loads(cPickle.dumps(cache))
+        >>> worker.enforceLimit, worker.currentBytes
+        (False, None)
+        >>> shutil.rmtree(cacheDir); shutil.rmtree(sourceDir)
+    """
+    def __init__(self, cacheDir, maxBytes=DEFAULT_MAX_BYTES):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.currentBytes = None
+        self.enforceLimit = True
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def __getstate__(self):
+        # A copy sent to a pool worker: the parent keeps track of the size, see checkSize
+        state = dict(self.__dict__)
+        state["currentBytes"] = None
+        state["enforceLimit"] = False
+        return state
+
+    def entryPath(self, filename, profile="full"):
+        # Each extraction profile (see ast_parser.PROFILES) produces a different structure, they are cached apart
+        key = "%s\n%s\n%s\n%s" % ( ast_parser.PARSER_VERSION, profile, os.path.abspath(filename), filename )
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.cacheDir, digest[:2], "%s.pickle" % digest)
+
+    def loadEntry(self, entryPath):
+        try:
+            with open(entryPath, "rb") as fh:
+                return cPickle.load(fh)
+        except Exception:
+            return None
+
+    def writeEntry(self, entryPath, entry):
+        entryDir = os.path.dirname(entryPath)
+        if not os.path.isdir(entryDir):
+            try:
+                os.makedirs(entryDir)
+            except OSError:
+                pass # another worker got there first
+
+        # Write to a temporary file and rename it into place, so concurrent workers never see a partial entry
+        fd, tmpPath = tempfile.mkstemp(dir=entryDir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            cPickle.dump(entry, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpPath, entryPath)
+        return os.path.getsize(entryPath)
+
+    def get(self, filename, profile="full"):
+        """ Return the cached outbound structure for filename, or None when it has to be re-parsed. """
+        entryPath = self.entryPath(filename, profile)
+        if not os.path.exists(entryPath):
+            return None
+
+        entry = self.loadEntry(entryPath)
+        if entry is None or entry["version"] != ast_parser.PARSER_VERSION or entry["filename"] != filename:
+            return None
+
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+
+        if entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+            if entry["size"] != st.st_size or entry["hash"] != hashContent(open(filename).read()):
+                return None
+            # Same bytes, new mtime: remember the new mtime so the next lookup skips the hash
+            entry["mtime"] = st.st_mtime
+            replaced = self.entrySize(entryPath)
+            written = self.writeEntry(entryPath, entry)
+            if self.currentBytes is not None:
+                self.currentBytes += written - replaced
+        else:
+            os.utime(entryPath, None) # mark as recently used
+
+        return entry["result"]
+
+    def put(self, filename, fileContent, result, profile="full", st=None):
+        """ Store the outbound structure parsed from fileContent (with the given extraction profile).
+            st is the os.stat of filename taken before fileContent was read, so that an edit made in between
+            leaves an entry that doesn't match the file, rather than the new stamp on the old content.
+        """
+        if st is None:
+            st = os.stat(filename)
+        entry = {
+            "version" : ast_parser.PARSER_VERSION,
+            "filename" : filename,
+            "mtime" : st.st_mtime,
+            "size" : st.st_size,
+            "hash" : hashContent(fileContent),
+            "result" : result
+        }
+        entryPath = self.entryPath(filename, profile)
+        replaced = self.entrySize(entryPath)
+        written = self.writeEntry(entryPath, entry)
+        if not self.enforceLimit:
+            return
+
+        if self.currentBytes is None:
+            self.currentBytes = self.diskUsage()
+        else:
+            self.currentBytes += written - replaced
+
+        if self.currentBytes > self.maxBytes:
+            self.evict()
+
+    def checkSize(self):
+        """ Re-count what is on disk (after pool workers wrote to it) and evict if it went over maxBytes """
+        self.currentBytes = self.diskUsage()
+        if self.currentBytes > self.maxBytes:
+            self.evict()
+
+    def entrySize(self, entryPath):
+        """ The size of the entry at entryPath, 0 when there is none """
+        try:
+            return os.path.getsize(entryPath)
+        except OSError:
+            return 0
+
+    def entries(self):
+        for root, dirnames, filenames in os.walk(self.cacheDir):
+            for filename in filenames:
+                if filename.endswith(".pickle"):
+                    yield os.path.join(root, filename)
+
+    def diskUsage(self):
+        total = 0
+        for entryPath in self.entries():
+            try:
+                total += os.path.getsize(entryPath)
+            except OSError:
+                pass
+        return total
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache is back down to 3/4 of maxBytes. """
+        stats = []
+        for entryPath in self.entries():
+            try:
+                st = os.stat(entryPath)
+            except OSError:
+                continue
+            stats.append(( st.st_mtime, st.st_size, entryPath ))
+        stats.sort()
+
+        total = sum([ size for mtime, size, entryPath in stats ])
+        target = self.maxBytes * 3 / 4
+        for mtime, size, entryPath in stats:
+            if total <= target:
+                break
+            try:
+                os.remove(entryPath)
+                total -= size
+            except OSError:
+                pass
+        logging.debug("Evicted cache entries down to %d bytes", total)
+        self.currentBytes = total
+
+    def clear(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        os.makedirs(self.cacheDir)
+        self.currentBytes = 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "usage: parse_cache.py clear CACHE_DIR | test"
+        sys.exit(1)
+
+    if sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    if sys.argv[1] == "clear" and len(sys.argv) == 3:
+        ParseCache(sys.argv[2]).clear()
+        sys.exit(0)
+
+    print "usage: parse_cache.py clear CACHE_DIR | test"
+    sys.exit(1)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+"""
+Split the analysis of a tree into shards that can run as separate processes (or on separate machines sharing
+the tree), and merge their partial results back into what a single run would have produced.
+
+Files are assigned to shards by a stable hash of their path relative to the tree, so every shard computes the
+same partition independently.  A partial result holds the outbound structure of each of its files and the
+inheritance edges (base class name -> [ ( subclass, filename ) ]) found in them, along with the tree, the
+exclude patterns and the parser version it was computed with.  Merging checks that every shard is there exactly
+once and that they all agree on those, and unions the files and the edges, so inherits_from queries can be answered from
+the merged result.
+
+Examples:
+
+./shard_analysis.py run /opt/stack/nova/nova --shard 0 --shards 4 --output /tmp/nova.0
+./shard_analysis.py merge /tmp/nova.merged /tmp/nova.0 /tmp/nova.1 /tmp/nova.2 /tmp/nova.3
+./shard_analysis.py local /opt/stack/nova/nova --shards 4 --output /tmp/nova.merged --inherits model_base.BASEV2
+"""
+
+import cPickle
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+import ast_parser
+import file_walker
+import inherits_from
+import parse_cache
+
+def shardOf(filename, targetDir, shards):
+    """ The shard (0 .. shards - 1) filename belongs to, the same wherever the tree is
+
+        >>> shardOf("/opt/stack/nova/nova/db/api.py", "/opt/stack/nova", 4) == shardOf("/src/nova/nova/db/api.py", "/src/nova", 4)
+        True
+    """
+    relative = os.path.relpath(os.path.abspath(filename), os.path.abspath(targetDir))
+    return int(hashlib.sha1(relative).hexdigest()[:8], 16) % shards
+
+def shardFiles(targetDir, shard, shards, exclude=()):
+    return [ filename for filename in file_walker.listFiles([ targetDir ], exclude=exclude) if shardOf(filename, targetDir, shards) == shard ]
+
+def writeResult(path, result):
+    tmpPath = "%s.tmp" % path
+    with open(tmpPath, "wb") as fh:
+        cPickle.dump(result, fh, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmpPath, path)
+
+def loadResult(path):
+    with open(path, "rb") as fh:
+        result = cPickle.load(fh)
+    if result.get("version") != ast_parser.PARSER_VERSION:
+        raise Exception("%s was built by parser version %s, run it again" % ( path, result.get("version") ))
+    return result
+
+def runShard(targetDir, shard, shards, outputPath=None, cache=None, workers=1, exclude=()):
+    """ Parse the files of one shard, returning (and writing to outputPath) its partial result """
+    files = ast_parser.parseFiles(shardFiles(targetDir, shard, shards, exclude), workers, cache)
+    partial = {
+        "version" : ast_parser.PARSER_VERSION,
+        "targetDir" : os.path.abspath(targetDir),
+        "exclude" : list(exclude),
+        "shard" : shard,
+        "shards" : shards,
+        "files" : files,
+        "hierarchy" : inherits_from.buildHierarchy(files)
+    }
+    if outputPath is not None:
+        writeResult(outputPath, partial)
+    return partial
+
+def mergePartials(partials):
+    """ Combine the partial results of every shard of a run into one.
+
+        >>> import shutil, tempfile
+        >>> targetDir = tempfile.mkdtemp()
+        >>> for pos in range(6):
+        ...     open(os.path.join(targetDir, "m%d.py" % pos), "w").write("class C%d(C%d):\\n    pass\\n" % ( pos + 1, pos ))
+        >>> merged = mergePartials([ runShard(targetDir, shard, 3) for shard in range(3) ])
+        >>> merged["files"] == ast_parser.parseFiles(file_walker.listFiles([ targetDir ]))
+        True
+        >>> sorted(inherits_from.findSubclasses(merged["hierarchy"], [ "C3" ]).keys())
+        ['C4', 'C5', 'C6']
+        >>> mergePartials([ runShard(targetDir, 0, 3) ])
+        Traceback (most recent call last):
+        ...
+        Exception: missing shards [1, 2] of 3
+        >>> mergePartials([ runShard(targetDir, 0, 2), runShard(targetDir, 1, 2, exclude=[ "m1.py" ]) ])
+        Traceback (most recent call last):
+        ...
+        Exception: shard 1 was run with exclude ['m1.py'], shard 0 with []
+        >>> shutil.rmtree(targetDir)
+    """
+    if len(partials) == 0:
+        raise Exception("nothing to merge")
+
+    first = partials[0]
+    shards = first["shards"]
+    seen = set()
+    merged = { "version" : first["version"], "targetDir" : first["targetDir"], "exclude" : first["exclude"], "files" : {}, "hierarchy" : {} }
+    for partial in partials:
+        # Shards of different trees, filters or parsers would merge into something no single run gives
+        for key in ( "targetDir", "exclude", "version" ):
+            if partial[key] != first[key]:
+                raise Exception("shard %d was run with %s %r, shard %d with %r" % ( partial["shard"], key, partial[key], first["shard"], first[key] ))
+        if partial["shards"] != shards:
+            raise Exception("shard %d is one of %d, not of %d" % ( partial["shard"], partial["shards"], shards ))
+        if partial["shard"] in seen:
+            raise Exception("shard %d given twice" % partial["shard"])
+        seen.add(partial["shard"])
+
+        for filename, outbound in partial["files"].iteritems():
+            if filename in merged["files"]:
+                raise Exception("%s is in more than one shard" % filename)
+            merged["files"][filename] = outbound
+        for baseName, edges in partial["hierarchy"].iteritems():
+            merged["hierarchy"].setdefault(baseName, []).extend(edges)
+
+    missing = sorted(set(range(shards)) - seen)
+    if len(missing) > 0:
+        raise Exception("missing shards %s of %d" % ( missing, shards ))
+
+    # The same edge order buildHierarchy gives a single run
+    for edges in merged["hierarchy"].values():
+        edges.sort()
+    return merged
+
+def runLocal(targetDir, shards, outputPath, cacheDir=None, exclude=()):
+    """ Run every shard as its own process, wait for them, and merge their partial results into outputPath """
+    command = [ sys.executable, os.path.abspath(__file__), "run", targetDir, "--shards", str(shards) ]
+    if cacheDir is not None:
+        command.extend([ "--cache", cacheDir ])
+    for pattern in exclude:
+        command.extend([ "--exclude", pattern ])
+
+    partialPaths = [ "%s.shard%d" % ( outputPath, shard ) for shard in range(shards) ]
+    children = []
+    for shard in range(shards):
+        children.append(subprocess.Popen(command + [ "--shard", str(shard), "--output", partialPaths[shard] ]))
+    failed = [ shard for shard, child in enumerate(children) if child.wait() != 0 ]
+    if len(failed) > 0:
+        raise Exception("shards %s failed" % failed)
+
+    merged = mergePartials([ loadResult(path) for path in partialPaths ])
+    writeResult(outputPath, merged)
+    for path in partialPaths:
+        os.remove(path)
+    return merged
+
+def usage():
+    print "usage: shard_analysis.py run DIR --shard I --shards N --output PARTIAL [--jobs N] [--cache DIR] [--exclude PATTERN]..."
+    print "       shard_analysis.py merge OUTPUT PARTIAL... [--inherits CLASS]..."
+    print "       shard_analysis.py local DIR --shards N --output OUTPUT [--cache DIR] [--exclude PATTERN]... [--inherits CLASS]..."
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+    shard = ast_parser.popArgument(sys.argv, "--shard")
+    shards = ast_parser.popArgument(sys.argv, "--shards")
+    outputPath = ast_parser.popArgument(sys.argv, "--output")
+    cacheDir = ast_parser.popArgument(sys.argv, "--cache")
+    exclude = ast_parser.popArguments(sys.argv, "--exclude")
+    toCheck = ast_parser.popArguments(sys.argv, "--inherits")
+
+    if len(sys.argv) < 3:
+        usage()
+
+    command = sys.argv[1]
+    if command == "run" and len(sys.argv) == 3 and None not in ( shard, shards, outputPath ):
+        cache = None
+        if cacheDir is not None:
+            cache = parse_cache.ParseCache(cacheDir)
+        partial = runShard(sys.argv[2], int(shard), int(shards), outputPath, cache, jobs, exclude)
+        sys.stderr.write("shard %s of %s: %d files\n" % ( shard, shards, len(partial["files"]) ))
+        sys.exit(0)
+    elif command == "merge" and len(sys.argv) >= 4:
+        merged = mergePartials([ loadResult(path) for path in sys.argv[3:] ])
+        writeResult(sys.argv[2], merged)
+    elif command == "local" and len(sys.argv) == 3 and None not in ( shards, outputPath ):
+        merged = runLocal(sys.argv[2], int(shards), outputPath, cacheDir, exclude)
+    else:
+        usage()
+
+    if len(toCheck) > 0:
+        print json.dumps(inherits_from.findSubclasses(merged["hierarchy"], toCheck), indent=4, sort_keys=True)
+    else:
+        print "%d files merged" % len(merged["files"])
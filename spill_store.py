@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+A bounded-memory way of parsing very large trees.
+
+Each file's outbound structure is pickled as soon as it is parsed and buffered, up to a memory budget, before
+being appended to a shard file on disk.  Nothing but the buffer and an index of filename -> ( shard, offset,
+length ) is kept in memory.  The result is a LazyResult: it behaves like the dict parseFiles returns, but
+loads each file's structure from its shard when it is asked for.
+
+Examples:
+
+./spill_store.py build /tmp/nova.store --memory-budget 64 /opt/stack/nova/nova
+./spill_store.py show /tmp/nova.store nova/db/api.py
+"""
+
+import cPickle
+import fnmatch
+import os
+import sys
+from UserDict import DictMixin
+
+import ast_parser
+import file_walker
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+INDEX_NAME = "index.pickle"
+# Written into every store, so a directory is only ever cleared if it is one
+MARKER_NAME = ".spill_store"
+
+class ShardWriter(object):
+    """
+        Appends pickled per-file results to numbered shard files, flushing whenever the buffered bytes
+        reach memoryBudget, and starting a new shard once one reaches shardBytes.
+
+        directory must be new, empty, or a previous store (which is replaced).
+
+        >>> import shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> open(os.path.join(directory, "shard-00000.pickle"), "w").write("not a store")
+        >>> ShardWriter(directory) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        Exception: ... is not empty and not a spill store, refusing to clear it
+        >>> os.remove(os.path.join(directory, "shard-00000.pickle"))
+        >>> len(ShardWriter(directory).close())
+        0
+        >>> len(ShardWriter(directory).close())
+        0
+        >>> shutil.rmtree(directory)
+    """
+    def __init__(self, directory, memoryBudget=DEFAULT_MEMORY_BUDGET, shardBytes=DEFAULT_SHARD_BYTES):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = os.listdir(directory)
+        if len(entries) > 0 and MARKER_NAME not in entries:
+            raise Exception("%s is not empty and not a spill store, refusing to clear it" % directory)
+        for filename in entries:
+            if filename == INDEX_NAME or fnmatch.fnmatch(filename, "shard-*.pickle"):
+                os.remove(os.path.join(directory, filename))
+        open(os.path.join(directory, MARKER_NAME), "w").close()
+        self.directory = directory
+        self.memoryBudget = memoryBudget
+        self.shardBytes = shardBytes
+        self.index = {}
+        self.pending = []
+        self.pendingBytes = 0
+        self.shard = 0
+        self.shardSize = 0
+
+    def shardPath(self, shard):
+        return os.path.join(self.directory, "shard-%05d.pickle" % shard)
+
+    def add(self, filename, outbound):
+        data = cPickle.dumps(outbound, cPickle.HIGHEST_PROTOCOL)
+        self.pending.append(( filename, data ))
+        self.pendingBytes += len(data)
+        if self.pendingBytes >= self.memoryBudget:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with open(self.shardPath(self.shard), "ab") as fh:
+            for filename, data in self.pending:
+                self.index[filename] = ( self.shard, self.shardSize, len(data) )
+                fh.write(data)
+                self.shardSize += len(data)
+        self.pending = []
+        self.pendingBytes = 0
+
+        if self.shardSize >= self.shardBytes:
+            self.shard += 1
+            self.shardSize = 0
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.directory, INDEX_NAME), "wb") as fh:
+            cPickle.dump(self.index, fh, cPickle.HIGHEST_PROTOCOL)
+        return LazyResult(self.directory)
+
+class LazyResult(DictMixin):
+    """
+        The merged result of a spilled run, loaded one file at a time on demand.
+
+        >>> import shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> result = parseToStore([ sys.argv[0] ], directory, memoryBudget=1)
+        >>> result.keys() == [ sys.argv[0] ]
+        True
+        >>> result[sys.argv[0]] == ast_parser.parseFile(sys.argv[0])[sys.argv[0]]
+        True
+        >>> shutil.rmtree(directory)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_NAME), "rb") as fh:
+            self.index = cPickle.load(fh)
+
+    def __getitem__(self, filename):
+        shard, offset, length = self.index[filename]
+        with open(os.path.join(self.directory, "shard-%05d.pickle" % shard), "rb") as fh:
+            fh.seek(offset)
+            return cPickle.loads(fh.read(length))
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def iteritems(self):
+        """ Every ( filename, outbound ), reading each shard front to back once """
+        byShard = {}
+        for filename, ( shard, offset, length ) in self.index.iteritems():
+            byShard.setdefault(shard, []).append(( offset, length, filename ))
+        for shard in sorted(byShard.keys()):
+            with open(os.path.join(self.directory, "shard-%05d.pickle" % shard), "rb") as fh:
+                for offset, length, filename in sorted(byShard[shard]):
+                    fh.seek(offset)
+                    yield filename, cPickle.loads(fh.read(length))
+
+def parseToStore(files, directory, memoryBudget=DEFAULT_MEMORY_BUDGET, workers=1, cache=None):
+    """ Parse files, spilling each result to the shard store in directory, and return the LazyResult """
+    writer = ShardWriter(directory, memoryBudget)
+    for filename, outbound in ast_parser.iterParseFiles(files, workers, cache):
+        writer.add(filename, outbound)
+    return writer.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        import doctest
+        doctest.testmod(verbose=True)
+        sys.exit(0)
+
+    jobs = int(ast_parser.popArgument(sys.argv, "--jobs", "1"))
+    exclude = ast_parser.popArguments(sys.argv, "--exclude")
+    memoryBudget = int(ast_parser.popArgument(sys.argv, "--memory-budget", str(DEFAULT_MEMORY_BUDGET / 1024 / 1024))) * 1024 * 1024
+
+    if len(sys.argv) >= 4 and sys.argv[1] == "build":
+        files = file_walker.walkFiles(sys.argv[3:], exclude=exclude)
+        result = parseToStore(files, sys.argv[2], memoryBudget, jobs)
+        print "%d files stored in %s" % ( len(result), sys.argv[2] )
+    elif len(sys.argv) == 4 and sys.argv[1] == "show":
+        from pprint import pprint
+        pprint(LazyResult(sys.argv[2])[sys.argv[3]])
+    else:
+        print "usage: spill_store.py build STORE_DIR [--jobs N] [--memory-budget MB] [--exclude PATTERN]... FILE|DIR..."
+        print "       spill_store.py show STORE_DIR FILENAME"
+        sys.exit(1)